@@ -2,7 +2,11 @@
 #
 # Lexer for twiki parser.
 
+import array
+import bisect
 import cgi
+import collections
+import itertools
 import re
 import sys
 
@@ -23,7 +27,14 @@ class String(str):
 
 
 # Base class for all tokens.
+#
+# A large page has millions of tokens, so tokens use __slots__ instead of a
+# per-instance __dict__. Every subclass must define __slots__ too, otherwise
+# the __dict__ comes back.
 class Token(ll1.Terminal):
+  # 'link' and 'wiki_word' are only set for link tokens.
+  __slots__ = ('value', 'html', 'line_no', 'link', 'wiki_word')
+
   def __init__(self):
     """Initialize standard attributes of a token"""
     # 'value' is the corresponding twiki source for this token.
@@ -35,6 +46,22 @@ class Token(ll1.Terminal):
     # 'line_no' is the line number of this token.
     self.line_no = 0
 
+  def __getattr__(self, name):
+    # This is only called when the attribute is not set. Tokens created with
+    # lazy_html render 'html', and 'link' or 'wiki_word' of links, when any of
+    # them is first read.
+    if name in ('html', 'link', 'wiki_word') and not self.IsRendered():
+      RenderToken(self)
+      return getattr(self, name)
+    raise AttributeError(name)
+
+  def IsRendered(self):
+    try:
+      Token.html.__get__(self)
+      return True
+    except AttributeError:
+      return False
+
   def __str__(self):
     assert self.line_no > 0
     if self.value:
@@ -51,56 +78,598 @@ class Token(ll1.Terminal):
     return token
 
 
-class WORD(Token): pass
-class PUNCTURE(Token): pass
-
-class BOLD_WORD(Token): pass
-class BOLD_START_WORD(Token): pass
-class BOLD_END_WORD(Token): pass
-class ITALICS_WORD(Token): pass
-class ITALICS_START_WORD(Token): pass
-class ITALICS_END_WORD(Token): pass
-class FIXED_WIDTH_WORD(Token): pass
-class FIXED_WIDTH_START_WORD(Token): pass
-class FIXED_WIDTH_END_WORD(Token): pass
-
-class SHORT_LINK(Token): pass
-class LONG_LINK(Token): pass
-class LONG_LINK_START(Token): pass
-class LONG_LINK_END(Token): pass
-class URL(Token): pass
-class IMAGE_LINK(Token): pass
-
-class COLOR_START(Token): pass
-class ENDCOLOR(Token): pass
-
-class TITLE_LEAD1(Token): pass
-class TITLE_LEAD2(Token): pass
-class TITLE_LEAD3(Token): pass
-class TITLE_LEAD4(Token): pass
-class TITLE_LEAD5(Token): pass
-class TITLE_LEAD6(Token): pass
-
-class UNORDERED_LIST_LEAD1(Token): pass
-class UNORDERED_LIST_LEAD2(Token): pass
-class UNORDERED_LIST_LEAD3(Token): pass
-class UNORDERED_LIST_LEAD4(Token): pass
-class ORDERED_LIST_LEAD1(Token): pass
-class ORDERED_LIST_LEAD2(Token): pass
-class ORDERED_LIST_LEAD3(Token): pass
-class ORDERED_LIST_LEAD4(Token): pass
-
-class LINE_LEAD_WHITESPACE(Token): pass
-class TOC(Token): pass
-class VERBATIM(Token): pass
-class NEW_LINE(Token): pass
+class WORD(Token): __slots__ = ()
+class PUNCTURE(Token): __slots__ = ()
+
+class BOLD_WORD(Token): __slots__ = ()
+class BOLD_START_WORD(Token): __slots__ = ()
+class BOLD_END_WORD(Token): __slots__ = ()
+class ITALICS_WORD(Token): __slots__ = ()
+class ITALICS_START_WORD(Token): __slots__ = ()
+class ITALICS_END_WORD(Token): __slots__ = ()
+class FIXED_WIDTH_WORD(Token): __slots__ = ()
+class FIXED_WIDTH_START_WORD(Token): __slots__ = ()
+class FIXED_WIDTH_END_WORD(Token): __slots__ = ()
+
+class SHORT_LINK(Token): __slots__ = ()
+class LONG_LINK(Token): __slots__ = ()
+class LONG_LINK_START(Token): __slots__ = ()
+class LONG_LINK_END(Token): __slots__ = ()
+class URL(Token): __slots__ = ()
+class IMAGE_LINK(Token): __slots__ = ()
+
+class COLOR_START(Token): __slots__ = ()
+class ENDCOLOR(Token): __slots__ = ()
+
+class TITLE_LEAD1(Token): __slots__ = ()
+class TITLE_LEAD2(Token): __slots__ = ()
+class TITLE_LEAD3(Token): __slots__ = ()
+class TITLE_LEAD4(Token): __slots__ = ()
+class TITLE_LEAD5(Token): __slots__ = ()
+class TITLE_LEAD6(Token): __slots__ = ()
+
+class UNORDERED_LIST_LEAD1(Token): __slots__ = ()
+class UNORDERED_LIST_LEAD2(Token): __slots__ = ()
+class UNORDERED_LIST_LEAD3(Token): __slots__ = ()
+class UNORDERED_LIST_LEAD4(Token): __slots__ = ()
+class ORDERED_LIST_LEAD1(Token): __slots__ = ()
+class ORDERED_LIST_LEAD2(Token): __slots__ = ()
+class ORDERED_LIST_LEAD3(Token): __slots__ = ()
+class ORDERED_LIST_LEAD4(Token): __slots__ = ()
+
+class LINE_LEAD_WHITESPACE(Token): __slots__ = ()
+class TOC(Token): __slots__ = ()
+class VERBATIM(Token): __slots__ = ()
+class NEW_LINE(Token): __slots__ = ()
+
+# Token types in definition order. The index of a type is its type code.
+TOKEN_TYPE_LIST = Token.__subclasses__()
+TOKEN_TYPE_CODE = dict((token_type, code)
+                       for code, token_type in enumerate(TOKEN_TYPE_LIST))
+
+
+class TokenBuffer(object):
+  """A compact buffer of tokens.
+
+  Instead of one object per token, the buffer keeps tokens in parallel arrays:
+  type codes in an array('H'), line numbers in an array('I'), and value and
+  html as indexes into a string table where every distinct string is stored
+  only once. Token objects are created again when they are read, so the buffer
+  could be given to ll1.Parser.Parse directly.
+
+  Usage:
+    token_buffer = TokenBuffer(tokenize_iter(string))
+    for token in token_buffer:
+      ...
+  """
+
+  def __init__(self, token_list=()):
+    self.type_codes = array.array('H')
+    self.line_nos = array.array('I')
+    self.values = array.array('I')
+    self.htmls = array.array('I')
+
+    # The string table, and the index of each string in it.
+    self.string_table = []
+    self.string_index = {}
+
+    # 'link' and 'wiki_word' of the few link tokens, keyed by token index.
+    self.link_attributes = {}
+
+    for token in token_list:
+      self.Append(token)
+
+  def AddString_(self, string):
+    index = self.string_index.get(string)
+    if index is None:
+      index = len(self.string_table)
+      self.string_table.append(string)
+      self.string_index[string] = index
+    return index
+
+  def Append(self, token):
+    if hasattr(token, 'link') or hasattr(token, 'wiki_word'):
+      self.link_attributes[len(self.type_codes)] = (
+          getattr(token, 'link', None), getattr(token, 'wiki_word', None))
+
+    self.type_codes.append(TOKEN_TYPE_CODE[token.__class__])
+    self.line_nos.append(token.line_no)
+    self.values.append(self.AddString_(token.value))
+    self.htmls.append(self.AddString_(token.html))
+
+  def __len__(self):
+    return len(self.type_codes)
+
+  def __getitem__(self, index):
+    if index < 0:
+      index += len(self.type_codes)
+
+    token = Token.CreateWithLineNo(TOKEN_TYPE_LIST[self.type_codes[index]],
+                                   self.line_nos[index])
+    token.value = self.string_table[self.values[index]]
+    token.html = self.string_table[self.htmls[index]]
+    if index in self.link_attributes:
+      link, wiki_word = self.link_attributes[index]
+      if link is not None:
+        token.link = link
+      if wiki_word is not None:
+        token.wiki_word = wiki_word
+    return token
+
+  def __iter__(self):
+    for index in range(len(self.type_codes)):
+      yield self[index]
+
+
+def tokenize(string, multi_pass=False, word_cache=None, lazy_html=False):
+  """Tokenize the twiki source.
+
+  Args:
+    string: the twiki source.
+    multi_pass: if True, use the multi-pass reference implementation. It is
+        much slower but it is kept to verify the single pass lexer.
+    word_cache: an optional WordCache to reuse the tokens of repeated words.
+        It is not used by the multi-pass implementation.
+    lazy_html: if True, the 'html' of words and verbatim blocks is rendered
+        when it is first read, so consumers which only need the token types,
+        values and line numbers skip all escaping and formatting. It cannot
+        be used with word_cache, and it is not used by the multi-pass
+        implementation.
+
+  Returns:
+    A list of tokens.
+
+  Raises:
+    Error: when tokenize fails.
+    ValueError: when both word_cache and lazy_html are given.
+  """
+  if multi_pass:
+    return MultiPassTokenize(string)
+  else:
+    return list(tokenize_iter(string, word_cache, lazy_html))
+
+
+def tokenize_iter(string, word_cache=None, lazy_html=False):
+  """Tokenize the twiki source lazily.
+
+  Same as tokenize, but tokens are generated one at a time, so the caller,
+  for example ll1.Parser.Parse, can consume them while the source is being
+  tokenized.
+
+  Raises:
+    Error: when tokenize fails. Notice that it is raised when the failure is
+        found, after all the tokens before it have been generated.
+  """
+  return TokenizeString_(string, word_cache, lazy_html, None)
+
+
+def tokenize_spans(string, word_cache=None, lazy_html=False):
+  """Tokenize the twiki source, with the position of every token.
+
+  Same as tokenize_iter, but the offsets of every token in the source are
+  kept in a TokenSpans, which is filled as the tokens are generated. The
+  source of a NEW_LINE is the line break, which is empty at the end of a
+  source without a last line break. The source of a VERBATIM goes from
+  <verbatim> to </verbatim>. Use LineIndex to convert an offset into a line
+  number and a column.
+
+  Finding the offsets costs extra, about a quarter more time and a tenth more
+  memory than tokenize, so this is for tooling which needs the positions of
+  tokens, not a faster way to tokenize.
+
+  Usage:
+    token_iter, token_spans = tokenize_spans(string)
+    for index, token in enumerate(token_iter):
+      start, end = token_spans.Span(index)
+
+  Returns:
+    A tuple of (token iterator, TokenSpans).
+
+  Raises:
+    Error: when tokenize fails.
+  """
+  token_spans = TokenSpans()
+  return (TokenizeString_(string, word_cache, lazy_html, token_spans),
+          token_spans)
+
+
+class TokenSpans(object):
+  """The offsets of the tokens generated by tokenize_spans.
+
+  The offsets are kept in two arrays parallel to the tokens, instead of on
+  the tokens, so that tokens do not need two more slots each, and the tokens
+  of tokenize and tokenize_iter do not pay for them at all.
+  string[start:end] is the source of a token.
+  """
+
+  def __init__(self):
+    self.starts = array.array('L')
+    self.ends = array.array('L')
+
+  def __len__(self):
+    return len(self.starts)
+
+  def Span(self, index):
+    """Return (start, end) of the token at index."""
+    return (self.starts[index], self.ends[index])
+
+
+def TokenizeString_(string, word_cache, lazy_html, token_spans):
+  # Generate the tokens of tokenize_iter, or of tokenize_spans with
+  # token_spans.
+  verbatim_processor = VerbatimProcessor(lazy_html)
+  for item in TokenizeText_(string, 1, verbatim_processor, word_cache,
+                            lazy_html, token_spans):
+    yield item
+  verbatim_processor.Verify()
+
+
+def TokenizeText_(string, line_no, verbatim_processor, word_cache, lazy_html,
+                  token_spans):
+  # Tokenize string, whose first line is line_no, and which ends with a line
+  # break or at the end of the source. A <verbatim> block left open by the
+  # text before is continued line by line up to its end.
+  position = 0
+  if verbatim_processor.seen_verbatim:
+    position = FindLine_(string, '</verbatim>', 0)
+    if position == -1:
+      position = len(string)
+    else:
+      position += len('</verbatim>')
+      position += LineBreakLength_(string, position)
+    for item in TokenizeStringLines_(string, 0, position, line_no,
+                                     verbatim_processor, word_cache,
+                                     lazy_html, token_spans):
+      yield item
+    line_no += CountLineBreaks_(string, 0, position)
+    line_no += CountOtherLineBreaks_(string, 0, position)
+
+  for start, end in FindVerbatimBlocks(string, position):
+    for item in TokenizeStringLines_(string, position, start, line_no,
+                                     verbatim_processor, word_cache,
+                                     lazy_html, token_spans):
+      yield item
+    line_no += CountLineBreaks_(string, position, start)
+
+    # The content of the block is sliced out of the source only once,
+    # instead of being split into lines and joined again. Its line breaks
+    # are all '\n' in the value, as when it is joined.
+    content_start = start + len('<verbatim>')
+    content_start += LineBreakLength_(string, content_start)
+    content_end = end - len('</verbatim>')
+    content_end -= 2 if string.startswith('\r\n', content_end - 2) else 1
+    content = string[content_start:content_end]
+    if '\r' in content:
+      content = content.replace('\r\n', '\n')
+      if '\r' in content:
+        content = content.replace('\r', '\n')
+
+    # The block has the line breaks of the content, and the ones after
+    # <verbatim> and before </verbatim>, which are the same one if the block
+    # has no line between them.
+    verbatim = verbatim_processor.CreateVerbatim(content, line_no)
+    line_no += content.count('\n')
+    line_no += 2 if content_start <= content_end else 1
+    new_line = CreateNewLine(line_no)
+    line_no += 1
+    position = end + LineBreakLength_(string, end)
+    if token_spans is not None:
+      token_spans.starts.extend((start, end))
+      token_spans.ends.extend((end, position))
+    yield verbatim
+    yield new_line
+
+  for item in TokenizeStringLines_(string, position, len(string), line_no,
+                                   verbatim_processor, word_cache,
+                                   lazy_html, token_spans):
+    yield item
+
+
+def TokenizeStringLines_(string, start, end, line_no, verbatim_processor,
+                         word_cache, lazy_html, token_spans):
+  # Tokenize the lines of string[start:end], the first of which is line_no.
+  return TokenizeLines(enumerate(string[start:end].splitlines(), line_no),
+                       verbatim_processor,
+                       word_cache,
+                       lazy_html,
+                       string,
+                       start,
+                       token_spans)
+
+
+def tokenize_file_iter(input_file, word_cache=None, lazy_html=False):
+  """Tokenize a twiki source file lazily.
+
+  Same as tokenize_iter, but the source is read from input_file on demand, in
+  chunks of lines, see ReadChunks. So the whole source is never held in
+  memory, only a chunk, or a whole <verbatim> block.
+
+  Args:
+    input_file: a file object opened in text mode.
+    word_cache: an optional WordCache.
+    lazy_html: see tokenize.
+  """
+  verbatim_processor = VerbatimProcessor(lazy_html)
+  line_no = 1
+  for chunk in ReadChunks(input_file):
+    for token in TokenizeText_(chunk, line_no, verbatim_processor, word_cache,
+                               lazy_html, None):
+      yield token
+    # A chunk ends with a line break, so its last token is the NEW_LINE of
+    # its last line, unless the chunk ends inside a <verbatim> block.
+    if verbatim_processor.seen_verbatim:
+      line_no += CountLineBreaks_(chunk, 0, len(chunk))
+      line_no += CountOtherLineBreaks_(chunk, 0, len(chunk))
+    else:
+      line_no = token.line_no + 1
+  verbatim_processor.Verify()
+
+
+def ReadChunks(input_file, chunk_size=1 << 20):
+  """Read a file lazily in chunks of about chunk_size characters.
+
+  Every chunk but the last ends with a line break, so the lines of the chunks
+  are the same as the ones from str.splitlines of the whole file. A chunk
+  does not end inside a <verbatim> block, which is read to its end instead,
+  so the block could be sliced out of the chunk, see FindVerbatimBlocks.
+  """
+  part_list = []
+  in_verbatim = False
+  while True:
+    part = input_file.read(chunk_size)
+    if not part:
+      break
+    # A '\r' could be the first half of '\r\n'.
+    if not part.endswith('\n'):
+      part += input_file.readline()
+    part_list.append(part)
+    in_verbatim = EndsInVerbatim_(part, in_verbatim)
+    if not in_verbatim:
+      yield ''.join(part_list)
+      part_list = []
+  if part_list:
+    yield ''.join(part_list)
+
+
+def EndsInVerbatim_(string, in_verbatim):
+  # Return whether string ends inside a <verbatim> block, given whether it
+  # starts inside one. Lines after the last </verbatim> are outside.
+  position = 0
+  while True:
+    end = FindLine_(string, '</verbatim>', position)
+    if end == -1:
+      break
+    in_verbatim = False
+    position = end + len('</verbatim>')
+  return in_verbatim or FindLine_(string, '<verbatim>', position) != -1
+
+
+# The single pass lexer scans every line only once. The line lead and every
+# word are recognized as soon as they are split out of the line, so that no
+# intermediate list is built.
+def TokenizeLines(numbered_line_list, verbatim_processor, word_cache=None,
+                  lazy_html=False, source=None, start=0, token_spans=None):
+  """Generate the tokens of lines.
+
+  Args:
+    numbered_line_list: an iterable of (line_no, line).
+    verbatim_processor: the VerbatimProcessor keeping the <verbatim> state
+        between lines. The caller should call its Verify() at the end.
+    word_cache: an optional WordCache.
+    lazy_html: see tokenize.
+    source: the source of the lines, only needed with token_spans.
+    start: the offset of the first line in source.
+    token_spans: if given, the lines are the lines of source from offset
+        start, and the offsets of every token are added to token_spans, see
+        tokenize_spans.
+  """
+  create_word_token = GetWordTokenCreator(word_cache, lazy_html)
+  with_spans = token_spans is not None
+  if with_spans:
+    add_start = token_spans.starts.append
+    add_end = token_spans.ends.append
+  next_line_start = verbatim_start = start
+  for line_no, line in numbered_line_list:
+    if with_spans:
+      line_start = next_line_start
+      line_end = line_start + len(line)
+      next_line_start = line_end + LineBreakLength_(source, line_end)
+
+    # Lines inside <verbatim> are kept as is.
+    if verbatim_processor.seen_verbatim or line == '<verbatim>':
+      if with_spans and not verbatim_processor.seen_verbatim:
+        verbatim_start = line_start
+      for token in verbatim_processor.DoLine(line, line_no):
+        if with_spans:
+          add_start(verbatim_start)
+          add_end(line_end)
+        yield token
+      if verbatim_processor.seen_verbatim:
+        continue
+    elif line.strip():
+      lead, line = SplitLineLead(line, line_no)
+      if with_spans:
+        # The rest of the line after the lead is always a suffix of the line.
+        word_end = line_end - len(line)
+      if lead is not None:
+        if with_spans:
+          add_start(line_start)
+          add_end(word_end)
+        yield lead
+
+      for word in line.split():
+        if with_spans:
+          word_start = source.find(word, word_end)
+          word_end = word_start + len(word)
+        if word[-1] in PUNCTURE_SET:
+          token = create_word_token(word[:-1], line_no)
+          puncture = CreatePuncture(word[-1], line_no)
+          if with_spans:
+            add_start(word_start)
+            add_end(word_end - 1)
+            add_start(word_end - 1)
+            add_end(word_end)
+          yield token
+          yield puncture
+        else:
+          token = create_word_token(word, line_no)
+          if with_spans:
+            add_start(word_start)
+            add_end(word_end)
+          yield token
+
+    new_line = CreateNewLine(line_no)
+    if with_spans:
+      add_start(line_end)
+      add_end(next_line_start)
+    yield new_line
+
+
+# Line breaks recognized by str.splitlines.
+LINE_BREAK_REGEXP = re.compile(
+    r'\r\n|[\n\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029]')
+
+
+class LineIndex(object):
+  """Convert offsets in a source into line numbers and columns.
+
+  The start offset of every line is computed once, and each conversion is a
+  binary search, so only the offsets of tokens need to be kept.
+
+  Usage:
+    line_index = LineIndex(string)
+    line_no, column = line_index.Position(offset)
+  """
+
+  def __init__(self, string):
+    self.line_starts = array.array('L', [0])
+    for match_object in LINE_BREAK_REGEXP.finditer(string):
+      self.line_starts.append(match_object.end())
+
+  def LineNo(self, offset):
+    return bisect.bisect_right(self.line_starts, offset)
+
+  def Position(self, offset):
+    """Return (line number, column) of offset. Column starts from 0."""
+    line_no = self.LineNo(offset)
+    return (line_no, offset - self.line_starts[line_no - 1])
+
+
+def GetWordTokenCreator(word_cache, lazy_html):
+  """Return the function creating the token of a word, see tokenize."""
+  if word_cache is not None and lazy_html:
+    raise ValueError('word_cache cannot be used with lazy_html')
+  if word_cache is not None:
+    return word_cache.CreateWordToken
+  elif lazy_html:
+    return CreateLazyWordToken
+  else:
+    return CreateWordToken
+
+
+def CreatePuncture(value, line_no):
+  puncture = Token.CreateWithLineNo(PUNCTURE, line_no)
+  puncture.value = value
+  puncture.html = value
+  return puncture
+
+
+def CreateNewLine(line_no):
+  new_line = Token.CreateWithLineNo(NEW_LINE, line_no)
+  new_line.value = '\n'
+  new_line.html = '\n'
+  return new_line
+
+
+def retokenize(token_list, line_list, first_line_no, old_line_count,
+               new_line_count, word_cache=None):
+  """Tokenize an edited source incrementally.
+
+  Except <verbatim>, every line is tokenized on its own, so only the edited
+  lines, plus the <verbatim> blocks the edit touches, are tokenized again.
+  The tokens before and after them are reused, and token_list is updated in
+  place, by replacing the tokens of the edited lines with the new ones.
+
+  Tokenizing takes time in proportion to the size of the edit. But tokens
+  keep absolute line numbers, so when the edit changes the number of lines,
+  the line numbers of all the tokens after it are shifted too, which takes
+  time in proportion to the rest of the page. Replacing the tokens in
+  token_list moves the tokens after them, which is a fast memory move.
+
+  Args:
+    token_list: the tokens of the source before the edit.
+    line_list: the lines of the source after the edit.
+    first_line_no: the line number of the first edited line.
+    old_line_count: the number of lines replaced by the edit.
+    new_line_count: the number of lines replacing them.
+    word_cache: an optional WordCache.
+
+  Returns:
+    token_list, which now has the tokens of the source after the edit.
+
+  Raises:
+    Error: when tokenize fails. token_list is not changed then.
+  """
+  # Start from the <verbatim> line if the edit starts inside a verbatim block.
+  start_index = FindFirstTokenOfLine_(token_list, first_line_no)
+  start_line_no = first_line_no
+  if start_index > 0 and type(token_list[start_index-1]) == VERBATIM:
+    start_index -= 1
+    start_line_no = token_list[start_index].line_no
+  elif (start_index < len(token_list) and
+        type(token_list[start_index]) == VERBATIM):
+    start_line_no = token_list[start_index].line_no
+
+  # Tokenize the edited lines, and the lines after them until both the old
+  # and the new tokens are outside of any verbatim block at the same line.
+  line_no_delta = new_line_count - old_line_count
+  verbatim_processor = VerbatimProcessor()
+  new_token_list = []
+  line_no = start_line_no
+  while line_no <= len(line_list):
+    if (line_no >= first_line_no + new_line_count and
+        not verbatim_processor.seen_verbatim):
+      index = FindFirstTokenOfLine_(token_list, line_no - line_no_delta)
+      if not ((index < len(token_list) and
+               type(token_list[index]) == VERBATIM) or
+              (index > 0 and type(token_list[index-1]) == VERBATIM)):
+        # Reuse the rest of the old tokens.
+        if line_no_delta:
+          for token in itertools.islice(token_list, index, None):
+            token.line_no += line_no_delta
+        token_list[start_index:index] = new_token_list
+        return token_list
+
+    new_token_list.extend(TokenizeLines([(line_no, line_list[line_no-1])],
+                                        verbatim_processor,
+                                        word_cache))
+    line_no += 1
+
+  verbatim_processor.Verify()
+  token_list[start_index:] = new_token_list
+  return token_list
+
+
+def FindFirstTokenOfLine_(token_list, line_no):
+  # Binary search the index of the first token at or after line_no. Line
+  # numbers of tokens never decrease, since the VERBATIM token, which has the
+  # line number of <verbatim>, is generated at the line of </verbatim>.
+  low = 0
+  high = len(token_list)
+  while low < high:
+    middle = (low + high) // 2
+    if token_list[middle].line_no < line_no:
+      low = middle + 1
+    else:
+      high = middle
+  return low
 
 
 # The implementation is quite strightforward. We keep the parsed tokens and
 # unparsed strings in a list and begin with a list of string.  We then scan
 # all the elements in the list in several passes. Each pass skips parsed tokens
 # and only looks at unparsed strings and generates tokens out of them.
-def tokenize(string):
+def MultiPassTokenize(string):
   # Split the input into a list strings.
   token_list = []
   for line_no, line in enumerate(string.splitlines()):
@@ -154,43 +723,138 @@ def tokenize(string):
 
 
 class VerbatimProcessor(object):
-  def __init__(self):
+  def __init__(self, lazy_html=False):
+    self.lazy_html = lazy_html
     self.seen_verbatim = False
     self.line_no = 0
     self.content = []
 
   def Do(self, token):
+    if type(token) == String:
+      return self.DoLine(token, token.line_no)
+    elif self.seen_verbatim:
+      assert type(token) == NEW_LINE
+      return []
+    else:
+      return [token]
+
+  def DoLine(self, line, line_no):
     if self.seen_verbatim:
-      if type(token) == String:
-        if token == '</verbatim>':
-          self.seen_verbatim = False
-          verbatim = Token.CreateWithLineNo(VERBATIM, self.line_no)
-          verbatim.value = '\n'.join(self.content)
-          verbatim.html = '<pre>\n%s\n</pre>\n' % verbatim.value
-          self.content = []
-          return [verbatim]
-        else:
-          self.content.append(token)
-          return []
+      if line == '</verbatim>':
+        self.seen_verbatim = False
+        verbatim = self.CreateVerbatim('\n'.join(self.content), self.line_no)
+        self.content = []
+        return [verbatim]
       else:
-        assert type(token) == NEW_LINE
+        self.content.append(line)
         return []
     else:
-      if type(token) == String:
-        if token == '<verbatim>':
-          self.seen_verbatim = True
-          self.line_no = token.line_no
-          return []
-        else:
-          return [token]
+      if line == '<verbatim>':
+        self.seen_verbatim = True
+        self.line_no = line_no
+        return []
       else:
-        return [token]
+        return [line]
 
   def Verify(self):
     if self.seen_verbatim:
       raise Error('Unbalanced verbatim, start mark seen at %s' % self.line_no)
 
+  def CreateVerbatim(self, value, line_no):
+    verbatim = Token.CreateWithLineNo(VERBATIM, line_no)
+    verbatim.value = value
+    if self.lazy_html:
+      del verbatim.html
+    else:
+      RenderToken(verbatim)
+    return verbatim
+
+
+# Line breaks recognized by str.splitlines, except '\r\n', '\n' and '\r'.
+ASCII_OTHER_LINE_BREAK_LIST = ['\x0b', '\x0c', '\x1c', '\x1d', '\x1e']
+OTHER_LINE_BREAK_LIST = ASCII_OTHER_LINE_BREAK_LIST + ['\x85', '\u2028',
+                                                       '\u2029']
+
+
+def FindVerbatimBlocks(string, position=0):
+  """Find the <verbatim> blocks directly in the source.
+
+  Only '\n', '\r\n' and '\r' line breaks are recognized here, so nothing is
+  found when the source has any other line break. The lines are then
+  tokenized one by one, and the VerbatimProcessor handles the blocks instead.
+
+  Args:
+    string: the source.
+    position: where to start, which should be the start of a line.
+
+  Yields:
+    A tuple of (start, end) for each block, where string[start:end] is the
+    block from '<verbatim>' to '</verbatim>', without the last line break.
+  """
+  if CountOtherLineBreaks_(string, position, len(string)):
+    return
+
+  while True:
+    start = FindLine_(string, '<verbatim>', position)
+    if start == -1:
+      return
+    end = FindLine_(string, '</verbatim>', start + len('<verbatim>'))
+    if end == -1:
+      # The VerbatimProcessor will report the unbalanced verbatim.
+      return
+    end += len('</verbatim>')
+    yield (start, end)
+    position = end
+
+
+def FindLine_(string, line, position):
+  # Find the first whole line equal to 'line' starting at or after position.
+  while True:
+    position = string.find(line, position)
+    if position == -1:
+      return -1
+    if ((position == 0 or string[position-1] in '\n\r') and
+        (string.startswith(('\n', '\r'), position + len(line)) or
+         position + len(line) == len(string))):
+      return position
+    position += len(line)
+
+
+def LineBreakLength_(string, position):
+  # The length of the line break at position, the end of a line found by
+  # FindLine_, which is 0 at the end of string.
+  if string.startswith('\r\n', position):
+    return 2
+  return 1 if position < len(string) else 0
+
+
+def CountLineBreaks_(string, start, end):
+  # Count the '\n', '\r\n' and '\r' line breaks in string[start:end].
+  count = string.count('\n', start, end)
+  carriage_return_count = string.count('\r', start, end)
+  if carriage_return_count:
+    count += carriage_return_count - string.count('\r\n', start, end)
+  return count
+
+
+def CountOtherLineBreaks_(string, start, end):
+  # Count the other line breaks in string[start:end]. Counting them one by one
+  # is several times faster than searching for any of them with a regular
+  # expression, and most sources do not have the ones beyond ASCII at all.
+  if string.isascii():
+    line_break_list = ASCII_OTHER_LINE_BREAK_LIST
+  else:
+    line_break_list = OTHER_LINE_BREAK_LIST
+  count = 0
+  for line_break in line_break_list:
+    count += string.count(line_break, start, end)
+  return count
 
+
+# ProcessLineLead, ProcessPuncture, ProcessVariable and WordProcessor.Do
+# are only used by MultiPassTokenize. They keep the original algorithm,
+# instead of calling SplitLineLead and WordProcessor.Classify, so that the
+# multi-pass lexer could verify the single pass one.
 def ProcessLineLead(token):
   if type(token) != String:
     return [token]
@@ -255,6 +919,58 @@ def ProcessLineLead(token):
   return [token]
 
 
+# Title leads, indexed by the number of '+' minus one.
+TITLE_LEAD_LIST = [TITLE_LEAD1, TITLE_LEAD2, TITLE_LEAD3,
+                   TITLE_LEAD4, TITLE_LEAD5, TITLE_LEAD6]
+
+# List leads, keyed by (number of leading spaces, list marker). Every list
+# level is indented by 3 more spaces.
+LIST_LEAD_TABLE = {}
+for level, (unordered_list_lead, ordered_list_lead) in enumerate(
+    zip([UNORDERED_LIST_LEAD1, UNORDERED_LIST_LEAD2,
+         UNORDERED_LIST_LEAD3, UNORDERED_LIST_LEAD4],
+        [ORDERED_LIST_LEAD1, ORDERED_LIST_LEAD2,
+         ORDERED_LIST_LEAD3, ORDERED_LIST_LEAD4]), 1):
+  LIST_LEAD_TABLE[(3*level, '*')] = unordered_list_lead
+  LIST_LEAD_TABLE[(3*level, '1')] = ordered_list_lead
+  LIST_LEAD_TABLE[(3*level, '#')] = ordered_list_lead
+
+
+def SplitLineLead(line, line_no):
+  """Split the title_lead, list_lead or line_lead_whitespace out of a line.
+
+  The lead is found by looking at the leading '---+' or spaces and the
+  marker after them only once, so the cost does not depend on how many
+  title and list levels there are.
+
+  Returns:
+    A tuple of (lead token, rest of the line). The lead token is None if the
+    line has no lead.
+  """
+  first = line[:1]
+
+  # Titles. More '+' than the deepest title level are left in the line.
+  if first == '-' and line.startswith('---+'):
+    level = min(len(line) - 3 - len(line[3:].lstrip('+')),
+                len(TITLE_LEAD_LIST))
+    return (Token.CreateWithLineNo(TITLE_LEAD_LIST[level-1], line_no),
+            line[3+level:])
+
+  # Lists.
+  if first == ' ':
+    rest = line.lstrip(' ')
+    list_lead = LIST_LEAD_TABLE.get((len(line) - len(rest), rest[:1]))
+    if list_lead is not None and rest[1:2] == ' ':
+      return (Token.CreateWithLineNo(list_lead, line_no), rest[2:])
+
+  # Test line leading whitespace.
+  if first == ' ' or first == '\t':
+    return (Token.CreateWithLineNo(LINE_LEAD_WHITESPACE, line_no),
+            line.lstrip())
+
+  return (None, line)
+
+
 def SplitLineIntoWord(token):
   if type(token) != String:
     return [token]
@@ -262,6 +978,10 @@ def SplitLineIntoWord(token):
     return [String(new_token, token.line_no) for new_token in token.split()]
 
 
+#TODO: Add (), {} and [] support.
+PUNCTURE_SET = ('.', ',', ';', ':', '!', '?')
+
+
 def ProcessPuncture(token):
   if type(token) != String:
     return [token]
@@ -306,6 +1026,106 @@ def ProcessVariable(token):
   return [token]
 
 
+def CreateVariable(word, line_no):
+  """Create the token for a wiki variable, or None if word is not one."""
+  if word == '%RED%' or word == '%BLUE%' or word == '%GREEN%':
+    color_start = Token.CreateWithLineNo(COLOR_START, line_no)
+    color_start.value = word
+    color_start.html = "<font color='%s'>" % word[1:-1]
+    return color_start
+
+  if word == '%ENDCOLOR%':
+    end_color = Token.CreateWithLineNo(ENDCOLOR, line_no)
+    end_color.value = word
+    end_color.html = '</font>'
+    return end_color
+
+  if word == '%TOC%':
+    toc = Token.CreateWithLineNo(TOC, line_no)
+    toc.value = word
+    toc.html = '<toc/>'
+    return toc
+
+  return None
+
+
+def CreateWordToken(word, line_no):
+  """Create the token for a word split out of a line, without puncture."""
+  token = CreateVariable(word, line_no)
+  if token is None:
+    token = WordProcessor.Classify(word, line_no)
+  return token
+
+
+def CreateLazyWordToken(word, line_no):
+  """Same as CreateWordToken, but the html is rendered on first access."""
+  token = CreateVariable(word, line_no)
+  if token is None:
+    token = WordProcessor.Classify(word, line_no, lazy_html=True)
+  return token
+
+
+class WordCache(object):
+  """A bounded LRU cache of the tokens of words.
+
+  Wiki pages repeat the same words all the time. The cache keeps the type,
+  value and html of the tokens of the most recently used words, so that a
+  repeated word only needs a new token with its line number. A cache could
+  be shared by many tokenize calls in a long-running process, including
+  calls from different threads, for which hits and misses are approximate.
+
+  Usage:
+    word_cache = WordCache()
+    token_list = tokenize(string, word_cache=word_cache)
+    print(word_cache.hits, word_cache.misses)
+  """
+
+  def __init__(self, max_size=10000):
+    self.max_size = max_size
+
+    # Key is the word, value is a tuple of (token type, value, html, link,
+    # wiki_word). The least recently used word comes first.
+    self.entries = collections.OrderedDict()
+
+    self.hits = 0
+    self.misses = 0
+
+  def CreateWordToken(self, word, line_no):
+    # Every operation on entries is atomic, but another thread could evict
+    # the word between them, which is a miss.
+    entry = self.entries.get(word)
+    if entry is not None:
+      try:
+        self.entries.move_to_end(word)
+      except KeyError:
+        entry = None
+    if entry is None:
+      self.misses += 1
+      token = CreateWordToken(word, line_no)
+      self.entries[word] = (token.__class__,
+                            token.value,
+                            token.html,
+                            getattr(token, 'link', None),
+                            getattr(token, 'wiki_word', None))
+      if len(self.entries) > self.max_size:
+        try:
+          self.entries.popitem(last=False)
+        except KeyError:
+          pass
+      return token
+
+    self.hits += 1
+    token_type, value, html, link, wiki_word = entry
+    token = Token.CreateWithLineNo(token_type, line_no)
+    token.value = value
+    token.html = html
+    if link is not None:
+      token.link = link
+    if wiki_word is not None:
+      token.wiki_word = wiki_word
+    return token
+
+
 # Use a class to avoid compiling regular expression multiple times.
 class WordProcessor(object):
   short_link_regexp = re.compile(r'\[\[(?! )([^]]+)(?<! )\]\]')
@@ -445,25 +1265,177 @@ class WordProcessor(object):
 
     # Everything else is a normal word.
     word = Token.CreateWithLineNo(WORD, token.line_no)
-    word.value = cgi.escape(token)
-    word.html = word.value
+    word.value = token
+    word.html = cgi.escape(token)
     return [word]
 
+  # Format markers, keyed by the marker character. Each value is a tuple of
+  # (priority, word type, start word type, end word type). When a word starts
+  # and ends with different markers, the one with the smaller priority wins,
+  # e.g. '_abc*' is a BOLD_END_WORD.
+  marker_table = {
+      '*': (0, BOLD_WORD, BOLD_START_WORD, BOLD_END_WORD),
+      '_': (1, ITALICS_WORD, ITALICS_START_WORD, ITALICS_END_WORD),
+      '=': (2, FIXED_WIDTH_WORD, FIXED_WIDTH_START_WORD, FIXED_WIDTH_END_WORD),
+      }
+
+  # Formatted words, keyed by token type. Each value is a tuple of (start
+  # tag, end tag, start, end), where word[start:end] is the formatted text.
+  format_table = {
+      BOLD_WORD: ('<b>', '</b>', 1, -1),
+      BOLD_START_WORD: ('<b>', '', 1, None),
+      BOLD_END_WORD: ('', '</b>', 0, -1),
+      ITALICS_WORD: ('<i>', '</i>', 1, -1),
+      ITALICS_START_WORD: ('<i>', '', 1, None),
+      ITALICS_END_WORD: ('', '</i>', 0, -1),
+      FIXED_WIDTH_WORD: ('<code>', '</code>', 1, -1),
+      FIXED_WIDTH_START_WORD: ('<code>', '', 1, None),
+      FIXED_WIDTH_END_WORD: ('', '</code>', 0, -1),
+      }
+
+  @staticmethod
+  def Classify(token, line_no, lazy_html=False):
+    """Create the token for a word.
+
+    If lazy_html is True, 'html', and 'link' or 'wiki_word' of links, are not
+    set until they are first read, see Token.__getattr__.
+    """
+    token_type, match_object = WordProcessor.Match(token)
+    word = Token.CreateWithLineNo(token_type, line_no)
+    word.value = token
+    if lazy_html:
+      del word.html
+    else:
+      WordProcessor.Render(word, match_object)
+    return word
+
+  @staticmethod
+  def Match(token):
+    """Find the token type of a word.
+
+    Returns:
+      A tuple of (token type, match object). The match object is None unless
+      the type is found by a regular expression.
+    """
+    # Dispatch on the first and the last character for the formatted words.
+    start_marker = WordProcessor.marker_table.get(token[:1])
+    end_marker = WordProcessor.marker_table.get(token[-1:])
+    if start_marker is not None or end_marker is not None:
+      if start_marker is end_marker:
+        return (start_marker[1], None)
+      elif end_marker is None or (start_marker is not None and
+                                  start_marker[0] < end_marker[0]):
+        return (start_marker[2], None)
+      else:
+        return (end_marker[3], None)
+
+    # Links and urls must contain one of these, so most of the words do not
+    # need to try the regular expressions below.
+    if not ('[[' in token or ']]' in token or '://' in token):
+      return (WORD, None)
+
+    # TODO: We should have a clearer rule what is allowed in wiki-word.
+    for token_type, regexp in WordProcessor.regexp_list:
+      match_object = regexp.match(token)
+      if match_object:
+        return (token_type, match_object)
+
+    # Everything else is a normal word.
+    return (WORD, None)
+
+  @staticmethod
+  def Render(word, match_object=None):
+    """Set 'html', and 'link' or 'wiki_word' of links, of a word token."""
+    token = word.value
+    token_type = word.__class__
+    if token_type == WORD:
+      word.html = cgi.escape(token)
+      return
+
+    if token_type in WordProcessor.format_table:
+      start_tag, end_tag, start, end = WordProcessor.format_table[token_type]
+      word.html = start_tag + cgi.escape(token[start:end]) + end_tag
+      return
+
+    if match_object is None:
+      match_object = WordProcessor.regexp_table[token_type].match(token)
+
+    if token_type == SHORT_LINK:
+      wiki_word = cgi.escape(match_object.group(1).replace(r'"', r'_'))
+      word.html = "<a href='/pwdoc/ViewPage/%s'>%s</a>" % (wiki_word,
+                                                           wiki_word,)
+      word.wiki_word = wiki_word
+
+    elif token_type == IMAGE_LINK:
+      link = match_object.group(1)
+
+      attribute_list = []
+      for attribute in match_object.group(2).split(':'):
+        if attribute:
+          attribute_list.append(attribute)
+
+      word.html = "<img src='%s' %s/>" % (link, ' '.join(attribute_list))
+
+    elif token_type == LONG_LINK:
+      link = match_object.group(1)
+      text = cgi.escape(match_object.group(2))
+      word.html = "<a href='%s'>%s</a>" % (link, text)
+      word.link = link
+
+    elif token_type == LONG_LINK_START:
+      link = match_object.group(1)
+      text = cgi.escape(match_object.group(2))
+      word.html = "<a href='%s'>%s" % (link, text)
+      word.link = link
+
+    elif token_type == LONG_LINK_END:
+      text = cgi.escape(match_object.group(1))
+      word.html = "%s</a>" % text
+
+    elif token_type == URL:
+      word.html = "<a href='%s'>%s</a>" % (token, token)
+      word.link = token
+
+    else:
+      assert False, 'Not a word token: %s' % token_type
+
+
+# The regular expressions for links, in the order they are tried.
+WordProcessor.regexp_list = [
+    (SHORT_LINK, WordProcessor.short_link_regexp),
+    (IMAGE_LINK, WordProcessor.image_link_regexp),
+    (LONG_LINK, WordProcessor.long_link_regexp),
+    (LONG_LINK_START, WordProcessor.long_link_start_regexp),
+    (LONG_LINK_END, WordProcessor.long_link_end_regexp),
+    (URL, WordProcessor.url_regexp),
+    ]
+WordProcessor.regexp_table = dict(WordProcessor.regexp_list)
+
+
+def RenderToken(token):
+  """Render a token created with lazy_html."""
+  if token.__class__ == VERBATIM:
+    token.html = '<pre>\n%s\n</pre>\n' % token.value
+  else:
+    WordProcessor.Render(token)
+
 
 def main():
   if len(sys.argv) == 1:
-    input = sys.stdin.read()
+    input_file = sys.stdin
   else:
-    input = open(sys.argv[1]).read()
+    input_file = open(sys.argv[1])
 
+  # Tokens are printed as soon as they are generated, so the tokens before a
+  # failure are printed too.
   try:
-    token_list = tokenize(input)
+    for token in tokenize_file_iter(input_file):
+      print(token)
   except Error:
     print('lexer failed.')
     sys.exit(1)
-
-  for token in token_list:
-    print(token)
+  finally:
+    input_file.close()
 
 
 if __name__ == '__main__':
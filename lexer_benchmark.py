@@ -0,0 +1,295 @@
+#!/usr/bin/python3
+#
+# Throughput benchmark for the lexer. It generates a synthetic twiki document
+# and reports tokens/sec, MB/sec and peak memory for every lexer stage.
+#
+# Usage:
+#    python3 lexer_benchmark.py --size 4000000 --output result.json
+#    python3 lexer_benchmark.py --mix verbatim=5,link=0 --compare result.json
+
+import argparse
+import json
+import platform
+import random
+import subprocess
+import time
+import tracemalloc
+
+import lexer
+
+
+# Relative weights of line kinds and word kinds in the generated document.
+DEFAULT_FEATURE_MIX = {
+    # Line kinds.
+    'paragraph': 20,
+    'title': 2,
+    'list': 6,
+    'verbatim': 1,
+    'empty': 3,
+    # Word kinds.
+    'word': 60,
+    'puncture': 8,
+    'bold': 3,
+    'italics': 3,
+    'fixed_width': 3,
+    'link': 3,
+    'variable': 1,
+}
+
+LINE_KIND_LIST = ['paragraph', 'title', 'list', 'verbatim', 'empty']
+WORD_KIND_LIST = ['word', 'puncture', 'bold', 'italics', 'fixed_width', 'link',
+                  'variable']
+
+VOCABULARY = ('the of and to in is was for on that with as by at from this '
+              'page wiki topic parser lexer token table grammar release build '
+              'server client request response user admin cache index search '
+              'Web Main TWiki Sandbox WebHome WebPreferences').split()
+
+
+def ParseFeatureMix(string):
+  """Parse 'name=weight,...' into a feature mix over DEFAULT_FEATURE_MIX."""
+  feature_mix = dict(DEFAULT_FEATURE_MIX)
+  for item in string.split(','):
+    if not item:
+      continue
+    name, _, weight = item.partition('=')
+    if name not in feature_mix:
+      raise ValueError('Unknown feature: %s' % name)
+    feature_mix[name] = int(weight)
+  return feature_mix
+
+
+def GenerateWord(rng, feature_mix):
+  word = rng.choice(VOCABULARY)
+  kind = rng.choices(WORD_KIND_LIST,
+                     [feature_mix[kind] for kind in WORD_KIND_LIST])[0]
+  if kind == 'word':
+    return word
+  if kind == 'puncture':
+    return word + rng.choice('.,;:!?')
+  if kind in ('bold', 'italics', 'fixed_width'):
+    marker = {'bold': '*', 'italics': '_', 'fixed_width': '='}[kind]
+    if rng.random() < 0.7:
+      return marker + word + marker
+    return '%s%s %s %s%s' % (marker, word, rng.choice(VOCABULARY),
+                             rng.choice(VOCABULARY), marker)
+  if kind == 'link':
+    choice = rng.random()
+    if choice < 0.4:
+      return '[[%s%s]]' % (word.capitalize(), rng.choice(VOCABULARY))
+    if choice < 0.7:
+      return '[[http://example.com/%s][%s]]' % (word, word)
+    if choice < 0.85:
+      return '[[http://example.com/%s][%s %s]]' % (word, word,
+                                                    rng.choice(VOCABULARY))
+    return 'http://example.com/%s' % word
+  if kind == 'variable':
+    return '%%%s%% %s %%ENDCOLOR%%' % (rng.choice(['RED', 'BLUE', 'GREEN']),
+                                       word)
+  raise ValueError('Unknown word kind: %s' % kind)
+
+
+def GenerateLine(rng, feature_mix):
+  return ' '.join(GenerateWord(rng, feature_mix)
+                  for i in range(rng.randint(3, 15)))
+
+
+def GenerateDocument(size, feature_mix=None, seed=0):
+  """Generate a twiki document of about 'size' characters.
+
+  Args:
+    size: the approximate size of the document in characters.
+    feature_mix: a dict of relative weights of line kinds and word kinds,
+        see DEFAULT_FEATURE_MIX.
+    seed: seed of the random generator, so runs are repeatable.
+
+  Returns:
+    The document as a string.
+  """
+  if feature_mix is None:
+    feature_mix = DEFAULT_FEATURE_MIX
+  rng = random.Random(seed)
+  line_list = []
+  length = 0
+  list_level = 0
+  while length < size:
+    kind = rng.choices(LINE_KIND_LIST,
+                       [feature_mix[kind] for kind in LINE_KIND_LIST])[0]
+    if kind == 'paragraph':
+      new_line_list = [GenerateLine(rng, feature_mix)]
+    elif kind == 'title':
+      new_line_list = ['---%s %s' % ('+' * rng.randint(1, 6),
+                                     GenerateLine(rng, feature_mix))]
+    elif kind == 'list':
+      # A list item could only be nested one level deeper than the last one.
+      list_level = rng.randint(1, min(list_level + 1, 4))
+      new_line_list = ['%s%s %s' % ('   ' * list_level,
+                                    rng.choice('*1#'),
+                                    GenerateLine(rng, feature_mix))]
+    elif kind == 'verbatim':
+      new_line_list = (['<verbatim>'] +
+                       ['  %s <%s> *%s*' % (rng.choice(VOCABULARY),
+                                            rng.choice(VOCABULARY),
+                                            rng.choice(VOCABULARY))
+                        for i in range(rng.randint(1, 20))] +
+                       ['</verbatim>'])
+    else:
+      new_line_list = ['']
+
+    if kind != 'list':
+      list_level = 0
+    line_list.extend(new_line_list)
+    length += sum(len(line) + 1 for line in new_line_list)
+
+  return '\n'.join(line_list) + '\n'
+
+
+def Stages(document):
+  """Return a list of (stage name, function returning the token count).
+
+  The stages of the single pass lexer are measured one by one, each on the
+  output of the stage before it, followed by the whole lexer in several modes.
+  """
+  line_list = document.splitlines()
+  lead_and_rest_list = [lexer.SplitLineLead(line, line_no)
+                        for line_no, line in enumerate(line_list, 1)
+                        if line.strip()]
+  word_list = [word for lead, rest in lead_and_rest_list
+               for word in rest.split()]
+
+  def SplitLines():
+    return len(document.splitlines())
+
+  def LineLead():
+    return len([lexer.SplitLineLead(line, line_no)
+                for line_no, line in enumerate(line_list, 1)
+                if line.strip()])
+
+  def SplitWords():
+    return len([word for lead, rest in lead_and_rest_list
+                for word in rest.split()])
+
+  def Words():
+    return len([lexer.CreateWordToken(word, 1) for word in word_list])
+
+  def Tokenize():
+    return len(lexer.tokenize(document))
+
+  def TokenizeWithWordCache():
+    return len(lexer.tokenize(document, word_cache=lexer.WordCache()))
+
+  def TokenizeMultiPass():
+    return len(lexer.tokenize(document, multi_pass=True))
+
+  def TokenizeSpans():
+    token_iter, token_spans = lexer.tokenize_spans(document)
+    return len(list(token_iter))
+
+  def TokenBuffer():
+    return len(lexer.TokenBuffer(lexer.tokenize_iter(document)))
+
+  return [
+      ('split_lines', SplitLines),
+      ('line_lead', LineLead),
+      ('split_words', SplitWords),
+      ('words', Words),
+      ('tokenize', Tokenize),
+      ('tokenize_word_cache', TokenizeWithWordCache),
+      ('tokenize_multi_pass', TokenizeMultiPass),
+      ('tokenize_spans', TokenizeSpans),
+      ('token_buffer', TokenBuffer),
+  ]
+
+
+def Measure(document, repeat=3):
+  """Measure every stage, returning a dict keyed by stage name."""
+  megabytes = len(document.encode('utf-8')) / 1e6
+  result = {}
+  for name, stage in Stages(document):
+    # Time is the best of several runs without tracemalloc, which slows
+    # allocations down a lot.
+    best_seconds = None
+    for i in range(repeat):
+      start = time.perf_counter()
+      count = stage()
+      seconds = time.perf_counter() - start
+      if best_seconds is None or seconds < best_seconds:
+        best_seconds = seconds
+
+    tracemalloc.start()
+    stage()
+    peak_bytes = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    result[name] = {
+        'count': count,
+        'seconds': best_seconds,
+        'count_per_second': count / best_seconds,
+        'mb_per_second': megabytes / best_seconds,
+        'peak_memory_mb': peak_bytes / 1e6,
+    }
+  return result
+
+
+def GitRevision():
+  try:
+    return subprocess.check_output(
+        ['git', 'rev-parse', '--short', 'HEAD'],
+        stderr=subprocess.DEVNULL).decode().strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+
+def PrintReport(report, baseline=None):
+  print('%-22s %10s %14s %10s %12s' % ('stage', 'count', 'count/sec',
+                                       'MB/sec', 'peak MB'))
+  for name, stage in report['stages'].items():
+    line = '%-22s %10d %14.0f %10.2f %12.1f' % (name,
+                                                stage['count'],
+                                                stage['count_per_second'],
+                                                stage['mb_per_second'],
+                                                stage['peak_memory_mb'])
+    if baseline is not None and name in baseline['stages']:
+      line += '  x%.2f' % (baseline['stages'][name]['seconds'] /
+                           stage['seconds'])
+    print(line)
+
+
+def main():
+  argument_parser = argparse.ArgumentParser(
+      description='Throughput benchmark for the lexer.')
+  argument_parser.add_argument('--size', type=int, default=1000000,
+                               help='document size in characters')
+  argument_parser.add_argument('--mix', default='',
+                               help='feature weights, e.g. verbatim=5,link=0')
+  argument_parser.add_argument('--seed', type=int, default=0)
+  argument_parser.add_argument('--repeat', type=int, default=3)
+  argument_parser.add_argument('--output', help='save the result as JSON')
+  argument_parser.add_argument('--compare',
+                               help='a saved result to show speedup against')
+  args = argument_parser.parse_args()
+
+  feature_mix = ParseFeatureMix(args.mix)
+  document = GenerateDocument(args.size, feature_mix, args.seed)
+  report = {
+      'revision': GitRevision(),
+      'python': platform.python_version(),
+      'size': len(document),
+      'seed': args.seed,
+      'feature_mix': feature_mix,
+      'stages': Measure(document, args.repeat),
+  }
+
+  baseline = None
+  if args.compare:
+    with open(args.compare) as baseline_file:
+      baseline = json.load(baseline_file)
+  PrintReport(report, baseline)
+
+  if args.output:
+    with open(args.output, 'w') as output_file:
+      json.dump(report, output_file, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+  main()
@@ -3,10 +3,28 @@
 # Test routines for lexer. To run this test. In the top-level directory, run
 # python -m twiki.lexer_test
 
+import collections
+import io
 import textwrap
 
 import lexer
 
+
+def SameTokens(list_a, list_b):
+  # Whether two lists of tokens have the same types, values, html, line
+  # numbers and link attributes.
+  list_a = list(list_a)
+  list_b = list(list_b)
+  return (len(list_a) == len(list_b) and
+          all(type(a) == type(b) and
+              a.value == b.value and
+              a.html == b.html and
+              a.line_no == b.line_no and
+              getattr(a, 'link', None) == getattr(b, 'link', None) and
+              getattr(a, 'wiki_word', None) == getattr(b, 'wiki_word', None)
+              for a, b in zip(list_a, list_b)))
+
+
 token_list = lexer.tokenize('<verbatim>\ncode\n</verbatim>\n')
 if not(len(token_list) == 2 and
        type(token_list[0]) == lexer.VERBATIM and
@@ -184,3 +202,198 @@ if not(len(token_list) == 6 and
        type(token_list[4]) == lexer.URL and
        type(token_list[5]) == lexer.NEW_LINE):
   raise Exception(token_list)
+
+# The single pass lexer must generate the same tokens as the multi-pass one.
+source = textwrap.dedent("""\
+    ---++ Title with *bold* and %RED% color %ENDCOLOR%.
+    <verbatim>
+      code *not bold*
+    </verbatim>
+       * item _italics_ =fixed= [[WikiWord]], [[Link][Text]]!
+          1 item [[Link][Long text]] http://www.google.com
+     %TOC%
+    . , *a b* _a b_ =a b=
+    ---+++++++ Deep title
+    ---
+        * not a list
+       *not a list
+       # item
+    _abc* *abc_ =abc_ _abc= * = a<b&c [[a b]] [[Link][%IMAGE:width=6%]]
+    """)
+single_pass_list = lexer.tokenize(source)
+multi_pass_list = lexer.tokenize(source, multi_pass=True)
+if not SameTokens(single_pass_list, multi_pass_list):
+  raise Exception(single_pass_list)
+
+# tokenize_iter generates tokens before the whole source is tokenized.
+token_iter = lexer.tokenize_iter('abc\n<verbatim>\n')
+if type(next(token_iter)) != lexer.WORD:
+  raise Exception('tokenize_iter is not lazy')
+
+# TokenBuffer gives back the same tokens.
+token_buffer = lexer.TokenBuffer(lexer.tokenize_iter(source))
+if not SameTokens(token_buffer, single_pass_list):
+  raise Exception(list(token_buffer))
+
+# Words starting and ending with different markers.
+token_list = lexer.tokenize('_abc* *abc_ =abc_ _abc= * abc=def\n')
+if not(len(token_list) == 7 and
+       type(token_list[0]) == lexer.BOLD_END_WORD and
+       type(token_list[1]) == lexer.BOLD_START_WORD and
+       type(token_list[2]) == lexer.ITALICS_END_WORD and
+       type(token_list[3]) == lexer.ITALICS_START_WORD and
+       type(token_list[4]) == lexer.BOLD_WORD and
+       type(token_list[5]) == lexer.WORD and
+       type(token_list[6]) == lexer.NEW_LINE):
+  raise Exception(token_list)
+
+# WordCache reuses the tokens of repeated words.
+word_cache = lexer.WordCache(max_size=2)
+token_list = lexer.tokenize('abc *abc* abc\nabc [[Link][Text]]\n',
+                            word_cache=word_cache)
+if not(len(token_list) == 7 and
+       type(token_list[0]) == lexer.WORD and
+       type(token_list[1]) == lexer.BOLD_WORD and
+       type(token_list[2]) == lexer.WORD and
+       type(token_list[4]) == lexer.WORD and
+       token_list[4].line_no == 2 and
+       type(token_list[5]) == lexer.LONG_LINK and
+       token_list[5].link == 'Link' and
+       word_cache.hits == 2 and
+       word_cache.misses == 3 and
+       len(word_cache.entries) == 2):
+  raise Exception(token_list)
+
+# A word evicted by another thread between its lookup and its use is a miss.
+class EvictedEntries(collections.OrderedDict):
+  def move_to_end(self, key, last=True):
+    del self[key]
+    collections.OrderedDict.move_to_end(self, key, last)
+
+word_cache = lexer.WordCache()
+word_cache.entries = EvictedEntries()
+token_list = lexer.tokenize('abc abc', word_cache=word_cache)
+if not(len(token_list) == 3 and
+       token_list[1].value == 'abc' and
+       word_cache.hits == 0 and
+       word_cache.misses == 2 and
+       list(word_cache.entries) == ['abc']):
+  raise Exception(token_list)
+
+# retokenize gives the same tokens as tokenizing the edited source again, in
+# the list given to it.
+old_source = textwrap.dedent("""\
+    abc
+    <verbatim>
+    code
+    </verbatim>
+    def
+    hij
+    """)
+new_source = textwrap.dedent("""\
+    abc
+    <verbatim>
+    new code
+    more code
+    </verbatim>
+    def
+    hij
+    """)
+old_token_list = lexer.tokenize(old_source)
+token_list = lexer.retokenize(old_token_list, new_source.splitlines(), 3, 1, 2)
+expected_list = lexer.tokenize(new_source)
+if not(token_list is old_token_list and
+       SameTokens(token_list, expected_list)):
+  raise Exception(token_list)
+
+# The list is not changed when retokenize fails.
+old_token_list = lexer.tokenize(old_source)
+expected_list = lexer.tokenize(old_source)
+try:
+  lexer.retokenize(old_token_list, ['abc', '<verbatim>'], 2, 5, 1)
+  raise Exception('retokenize did not fail')
+except lexer.Error:
+  pass
+if not SameTokens(old_token_list, expected_list):
+  raise Exception(old_token_list)
+
+# tokenize_file_iter reads the lines from a file.
+token_list = list(lexer.tokenize_file_iter(io.StringIO(source)))
+if not SameTokens(token_list, single_pass_list):
+  raise Exception(token_list)
+
+# With lazy_html, html is rendered when it is first read, and the tokens are
+# the same. The value of a word is its source, unescaped, in both modes.
+token_list = lexer.tokenize(source, lazy_html=True)
+if not(not any(token.IsRendered() for token in token_list
+               if type(token) in (lexer.WORD, lexer.LONG_LINK,
+                                  lexer.VERBATIM)) and
+       'a<b&c' in [token.value for token in token_list] and
+       'a<b&c' in [token.value for token in single_pass_list] and
+       SameTokens(token_list, single_pass_list)):
+  raise Exception(token_list)
+
+# A word cache keeps rendered tokens, so it cannot be used with lazy_html.
+try:
+  lexer.tokenize(source, word_cache=lexer.WordCache(), lazy_html=True)
+  raise Exception('word_cache is used with lazy_html')
+except ValueError:
+  pass
+
+# Verbatim blocks found in the source give the same tokens as the ones found
+# line by line, which are used when the source has rare line breaks.
+for verbatim_source in ['<verbatim>\n</verbatim>',
+                        'a\n<verbatim>\n\n<verbatim>\n b\n</verbatim>\nc\n',
+                        'a\r\n<verbatim>\r\nb\r\n</verbatim>\r\nc',
+                        '<verbatim>\r\n\r\n\r</verbatim>\r\r\n<verbatim>\r'
+                        '</verbatim>\n',
+                        'a\x0c<verbatim>\nb\x0cc\r\n</verbatim>\nd']:
+  token_list = lexer.tokenize(verbatim_source)
+  expected_list = lexer.tokenize(verbatim_source, multi_pass=True)
+  if not SameTokens(token_list, expected_list):
+    raise Exception(token_list)
+
+# tokenize_spans gives the same tokens, with their offsets in the source.
+span_source = '---+ Title\n   * *bold* word.\r\n<verbatim>\nx\n</verbatim>\nend'
+token_iter, token_spans = lexer.tokenize_spans(span_source)
+span_list = list(token_iter)
+expected_list = lexer.tokenize(span_source)
+line_index = lexer.LineIndex(span_source)
+if not(SameTokens(span_list, expected_list) and
+       len(token_spans) == len(span_list) and
+       [span_source[start:end] for start, end in
+        map(token_spans.Span, range(len(token_spans)))] ==
+       ['---+', 'Title', '\n', '   * ', '*bold*', 'word', '.', '\r\n',
+        '<verbatim>\nx\n</verbatim>', '\n', 'end', ''] and
+       line_index.Position(token_spans.starts[5]) == (2, 12)):
+  raise Exception(span_list)
+
+# With '\n', '\r\n' or '\r' line breaks, the verbatim block is sliced out of
+# the source directly, and with other line breaks it is found line by line,
+# with the same spans.
+span_source = 'a\n<verbatim>\nx\n</verbatim>\nb\n<verbatim>\n</verbatim>'
+for line_break in ['\n', '\r\n', '\r', '\x0c']:
+  source = span_source.replace('\n', line_break)
+  token_iter, token_spans = lexer.tokenize_spans(source)
+  span_list = list(token_iter)
+  if not(len(list(lexer.FindVerbatimBlocks(source))) ==
+         (0 if line_break == '\x0c' else 2) and
+         [source[start:end] for start, end in
+          zip(token_spans.starts, token_spans.ends)] ==
+         [item.replace('\n', line_break) for item in
+          ['a', '\n', '<verbatim>\nx\n</verbatim>', '\n', 'b', '\n',
+           '<verbatim>\n</verbatim>', '']] and
+         [token.line_no for token in span_list] ==
+         [1, 1, 2, 4, 5, 5, 6, 7] and
+         span_list[2].value == 'x'):
+    raise Exception(span_list)
+
+# A file is read in chunks ending with a line break, and a chunk does not end
+# inside a verbatim block, so the block is found in the chunk.
+chunk_source = 'a\r\n<verbatim>\r\nx\r\n</verbatim>\r\nb\r\n'
+chunk_list = list(lexer.ReadChunks(io.StringIO(chunk_source, newline=''), 4))
+if not(chunk_list == ['a\r\n<verbatim>\r\nx\r\n</verbatim>\r\n', 'b\r\n'] and
+       [token.line_no for token in
+        lexer.tokenize_file_iter(io.StringIO(chunk_source, newline=''))] ==
+       [1, 1, 2, 4, 5, 5]):
+  raise Exception(chunk_list)
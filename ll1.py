@@ -2,26 +2,110 @@
 #
 # A strong-LL(1) parser.
 
+import collections
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+# Change this whenever the content of the grammar cache file changes.
+GRAMMAR_CACHE_VERSION = 2
+
+# The tables saved in the grammar cache file.
+GRAMMAR_CACHE_TABLE_LIST = ['FIRST_set', 'FOLLOW_set', 'parse_table']
+
 
 class Error(Exception): pass
 
 
-class Terminal(object): pass
+class Terminal(object):
+  # The parser puts terminals into the children of predict rules without
+  # changing them. Subclasses could define __slots__ to avoid a per-instance
+  # __dict__.
+  __slots__ = ()
 
 
 class END_OF_INPUT(Terminal): pass
 
 
 class PredictRule(object):
+  # Subclasses should define the class attribute 'right_hand_side_list'.
+  #
+  # The parser sets 'parent' and 'children_index' on every predict rule but
+  # the start one. Subclasses could define __slots__ to avoid a per-instance
+  # __dict__, since a large document has lots of predict rules.
+  __slots__ = ('children', 'parent', 'children_index')
+
   def __init__(self):
     # Object instances for the matched right_hand_side.
     self.children = []
 
-    # A dummy right hand side list. subclass should define this.
-    self.right_hand_side_list = []
+
+class Empty(PredictRule):
+  __slots__ = ()
+
+
+class ExpressionRule(PredictRule):
+  # A predict rule compiled from an Expression by the Parser. No node is
+  # created for it, its children are parsed into the predict rule the
+  # expression is in, so a repetition is one node with a child per element.
+  __slots__ = ()
+
+
+class Expression(object):
+  """Base class of the expressions, which are right hand side items besides
+  PredictRule and Terminal.
+
+  Every expression is compiled into an ExpressionRule, so it is checked by the
+  same LL(1) rules as the predict rules. As for predict rules, the parser is
+  greedy, and matches as many items as it can.
+
+  Usage:
+    class word_list(PredictRule):
+      right_hand_side_list = [[OneOrMore(word), Optional(PERIOD)]]
+  """
+
+  def __init__(self, item_list, right_hand_side_list):
+    """Initialize the expression, which is done by the subclasses.
+
+    Args:
+      item_list: the sequence of items, each a PredictRule, Terminal or
+          Expression.
+      right_hand_side_list: the right_hand_side_list of the ExpressionRule
+          compiled from the expression, in which the expression itself stands
+          for that ExpressionRule.
+    """
+    if len(item_list) == 0:
+      raise Error("%s of no item." % type(self).__name__)
+    self.item_list = list(item_list)
+    self.right_hand_side_list = right_hand_side_list
+
+
+class Optional(Expression):
+  """The items, or nothing."""
+
+  def __init__(self, *item_list):
+    Expression.__init__(self, item_list, [list(item_list), []])
+
+
+class ZeroOrMore(Expression):
+  """Any number of repetitions of the items."""
+
+  def __init__(self, *item_list):
+    # Parsing the rule again after the items is a loop, since no node is
+    # created for it.
+    Expression.__init__(self, item_list, [list(item_list) + [self], []])
 
 
-class Empty(PredictRule): pass
+class OneOrMore(Expression):
+  """One or more repetitions of the items."""
+
+  def __init__(self, *item_list):
+    # The items are checked before their ZeroOrMore is created.
+    Expression.__init__(self, item_list, [])
+    self.right_hand_side_list.append(
+        self.item_list + [ZeroOrMore(*item_list)])
 
 
 class Parser(object):
@@ -32,37 +116,74 @@ class Parser(object):
     analysis_stack = parser.Parse(terminal_list)
   """
 
-  def __init__(self, predict_rule_list):
+  def __init__(self, predict_rule_list, cache_path=None):
     """Initialize the parser.
 
     Args:
       predict_rule_list: a list of class. Each class is a subclass of
           PredictRule.  The first element is the start predict rule.
+      cache_path: an optional file to cache the FIRST_set, FOLLOW_set and
+          parse table in. When it holds the tables of the same grammar, they
+          are loaded instead of computed, otherwise they are computed and
+          saved into it.
 
     Raises:
       Error: when the grammar is not LL(1).
     """
-    self.predict_rule_list = predict_rule_list
+    # The ExpressionRule compiled from the expressions of the grammar are
+    # appended after the given predict rules, see ValidateRuleList_.
+    self.predict_rule_list = list(predict_rule_list)
+
+    # Key is predict rule, value is its right_hand_side_list with every
+    # Expression replaced by the ExpressionRule compiled from it.
+    self.right_hand_side_table = {}
+
+    # Predict rules before this index in predict_rule_list create nodes, and
+    # the ExpressionRule after it do not.
+    self.n_node_rules = len(self.predict_rule_list)
+
+    # Seconds spent in every step of building the parser, in order. See
+    # PrintBuildTimeReport.
+    self.build_time = {}
 
     # Set of Terminal and PredictRule types.
     self.terminal_type_set = set()
     self.predict_rule_type_set = set()
-    self.ValidateRuleList_()
+    self.TimeBuildStep_('validate', self.ValidateRuleList_)
 
     # FIRST_set for all the predict rules.
     # Key is predict rule, value is a set of terminals plus Empty rule.
     self.FIRST_set = {}
-    self.ComputeFirstSet_()
 
     # FOLLOW_set for all the predict rules.
     # Key is predict rule, value is a set of terminals.
     self.FOLLOW_set = {}
-    self.ComputeFollowSet_()
 
     # Parse table.
     # Key is (PredictRule, terminal) and value is the right hand side.
     self.parse_table = {}
-    self.GenerateParseTable_()
+
+    if not self.TimeBuildStep_('load_cache', self.LoadGrammarCache_,
+                               cache_path):
+      self.TimeBuildStep_('FIRST_set', self.ComputeFirstSet_)
+      self.TimeBuildStep_('FOLLOW_set', self.ComputeFollowSet_)
+      self.TimeBuildStep_('parse_table', self.GenerateParseTable_)
+      self.TimeBuildStep_('save_cache', self.SaveGrammarCache_, cache_path)
+
+    # The parse table compiled for Parse, see CompileParseTable_.
+    self.terminal_id_table = {}
+    self.symbol_id_table = {}
+    self.dense_parse_table = []
+    self.TimeBuildStep_('compile', self.CompileParseTable_)
+
+    # The Parse function of a generated module, see UseGeneratedModule.
+    self.generated_parse = None
+
+  def TimeBuildStep_(self, name, function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    self.build_time[name] = time.perf_counter() - start
+    return result
 
   def ValidateRuleList_(self):
     if len(self.predict_rule_list) == 0:
@@ -70,27 +191,65 @@ class Parser(object):
 
     # Collect all the PredictRule.
     for predict_rule in self.predict_rule_list:
-      if issubclass(predict_rule, PredictRule):
+      if issubclass(predict_rule, ExpressionRule):
+        raise Error("%s is an ExpressionRule, which is only compiled from an "
+                    "Expression" % predict_rule)
+      elif issubclass(predict_rule, PredictRule):
         self.predict_rule_type_set.add(predict_rule)
       else:
         raise Error("%s is not derived from PredictRule" % predict_rule)
 
+    # Compile the right hand sides, which appends the ExpressionRule to
+    # predict_rule_list.
+    for predict_rule in self.predict_rule_list[:self.n_node_rules]:
+      self.right_hand_side_table[predict_rule] = [
+          self.CompileRightHandSide_(predict_rule, index, right_hand_side)
+          for index, right_hand_side in enumerate(
+              predict_rule.right_hand_side_list)]
+
+  def CompileRightHandSide_(self, predict_rule, index, right_hand_side):
     # Collect all the Terminal and verify all PredictRule appearing in the right
-    # hand sides has a definition or every others are Terminal.
-    for predict_rule in self.predict_rule_list:
-      for right_hand_side in predict_rule.right_hand_side_list:
-        for item in right_hand_side:
-          if issubclass(item, PredictRule):
-            if item not in self.predict_rule_type_set:
-              raise Error("Undefined right hand side item: %s in "
-                          "predict rule: %s." % (item,
-                                                 predict_rule))
-          elif issubclass(item, Terminal):
-            self.terminal_type_set.add(item)
-          else:
-            raise Error("Right hand side item: %s in predict rule: %s is "
-                        "neither PredictRule nor Terminal." % (item,
-                                                               predict_rule))
+    # hand side has a definition or every others are Terminal. Return the
+    # right hand side with every Expression compiled into an ExpressionRule,
+    # which is named after its position.
+    compiled_right_hand_side = []
+    for item_index, item in enumerate(right_hand_side):
+      if isinstance(item, Expression):
+        item = self.CompileExpression_(item, '%s__%d_%d' % (
+            predict_rule.__name__, index, item_index))
+      elif not isinstance(item, type):
+        raise Error("Right hand side item: %s in predict rule: %s is "
+                    "neither PredictRule nor Terminal." % (item,
+                                                           predict_rule))
+      elif issubclass(item, PredictRule):
+        if item not in self.predict_rule_type_set:
+          raise Error("Undefined right hand side item: %s in "
+                      "predict rule: %s." % (item,
+                                             predict_rule))
+      elif issubclass(item, Terminal):
+        self.terminal_type_set.add(item)
+      else:
+        raise Error("Right hand side item: %s in predict rule: %s is "
+                    "neither PredictRule nor Terminal." % (item,
+                                                           predict_rule))
+      compiled_right_hand_side.append(item)
+    return compiled_right_hand_side
+
+  def CompileExpression_(self, expression, name):
+    # Return a new ExpressionRule parsing expression.
+    expression_rule = type(name, (ExpressionRule,), {'__slots__': ()})
+    self.predict_rule_list.append(expression_rule)
+    self.predict_rule_type_set.add(expression_rule)
+
+    expression_rule.right_hand_side_list = [
+        self.CompileRightHandSide_(expression_rule, index, [
+            expression_rule if item is expression else item
+            for item in right_hand_side])
+        for index, right_hand_side in enumerate(
+            expression.right_hand_side_list)]
+    self.right_hand_side_table[expression_rule] = (
+        expression_rule.right_hand_side_list)
+    return expression_rule
 
   def PrintInternalTable(self):
     print('='*20, 'FIRST_set', '='*20)
@@ -110,90 +269,114 @@ class Parser(object):
       print('%s, %s ==> %s' % (predict_rule, terminal, right_hand_side))
     print()
 
-  def AddToFirstSetOfRuleFromNthTermOfRightHandSide_(self, predict_rule,
-                                                     right_hand_side, index):
-    # If index is not an valid index, it means the right_hand_side is
-    # either empty, or every item before position 'index' could derive Empty.
-    # In any case, we should add Empty to FIRST_set since they both mean
-    # predict_rule can derive Empty.
-    if index == len(right_hand_side):
-      self.FIRST_set[predict_rule].add(Empty)
-      return
-
-    item = right_hand_side[index]
-
-    # If this is a terminal, add it.
-    if issubclass(item, Terminal):
-      self.FIRST_set[predict_rule].add(item)
-      return
-
-    # Now this is a predict rule, detect left recursive first.
-    if item == predict_rule and index == 0:
-      raise Error('Left recursive is not allowed. Found in %s.' % predict_rule)
-
-    # Add every element in the FIRST_set of this predict rule.  If any element
-    # is Empty, we need to consider next item in this right hand side.
-    for element in self.FIRST_set[item]:
-      if element == Empty:
-        self.AddToFirstSetOfRuleFromNthTermOfRightHandSide_(
-            predict_rule, right_hand_side, index+1)
-      else:
-        self.FIRST_set[predict_rule].add(element)
+  def PrintBuildTimeReport(self):
+    """Print the size of the grammar and the time of every build step."""
+    print('%d predict rules, %d right hand sides, %d terminals, '
+          '%d parse table entries' % (
+              len(self.predict_rule_list),
+              sum(len(right_hand_side_list)
+                  for right_hand_side_list in
+                  self.right_hand_side_table.values()),
+              len(self.terminal_type_set),
+              len(self.parse_table)))
+    for name, seconds in self.build_time.items():
+      print('%-12s %10.3f ms' % (name, seconds * 1000))
+    print('%-12s %10.3f ms' % ('total', sum(self.build_time.values()) * 1000))
 
   def ComputeFirstSet_(self):
     # Initialize the FIRST_set to empty.
     for predict_rule in self.predict_rule_list:
       self.FIRST_set[predict_rule] = set()
 
-    # Iterate to add Terminal or Empty to FIRST_set.
-    old_count = 0
-    while True:
-      for predict_rule in self.predict_rule_list:
-        for right_hand_side in predict_rule.right_hand_side_list:
-          self.AddToFirstSetOfRuleFromNthTermOfRightHandSide_(
-              predict_rule, right_hand_side, 0)
+    # The FIRST_set of A depends on the FIRST_set of every predict rule B in
+    # the right hand sides of A, so A is recomputed only after one of them
+    # changes, instead of rescanning every rule until nothing changes.
+    dependent_table = dict((predict_rule, set())
+                           for predict_rule in self.predict_rule_list)
+    for A in self.predict_rule_list:
+      for right_hand_side in self.right_hand_side_table[A]:
+        if right_hand_side and right_hand_side[0] == A:
+          raise Error('Left recursive is not allowed. Found in %s.' % A)
+        for B in right_hand_side:
+          if issubclass(B, PredictRule):
+            dependent_table[B].add(A)
+
+    # Every rule is computed after the rules it depends on, then again
+    # whenever they change, which only happens with recursion.
+    work_list = list(reversed(self.SortRulesByDependency_(dependent_table)))
+    work_set = set(work_list)
+    while work_list:
+      A = work_list.pop()
+      work_set.discard(A)
+
+      first_set = self.FIRST_set[A]
+      old_count = len(first_set)
+      for right_hand_side in self.right_hand_side_table[A]:
+        first_set |= self.GetFirstSetOfSententialForm_(right_hand_side, 0)
+
+      if len(first_set) != old_count:
+        for B in dependent_table[A]:
+          if B not in work_set:
+            work_list.append(B)
+            work_set.add(B)
+
+    # A right hand side is left recursive too if the items before A could all
+    # derive Empty, for example a repetition of items which could be empty,
+    # which would never end.
+    for A in self.predict_rule_list:
+      for right_hand_side in self.right_hand_side_table[A]:
+        for item in right_hand_side:
+          if item == A:
+            raise Error('Left recursive is not allowed. Found in %s.' % A)
+          if issubclass(item, Terminal) or Empty not in self.FIRST_set[item]:
+            break
 
-      new_count = sum([len(x) for x in self.FIRST_set.values()])
-      if new_count != old_count:
-        old_count = new_count
-      else:
-        break
+  def SortRulesByDependency_(self, dependent_table):
+    # Return the predict rules in depth first post order of the rules in
+    # their right hand sides, so a rule comes after all the rules it depends
+    # on unless they are recursive.
+    dependency_table = dict((predict_rule, [])
+                            for predict_rule in self.predict_rule_list)
+    for B, dependent_set in dependent_table.items():
+      for A in dependent_set:
+        dependency_table[A].append(B)
+
+    sorted_rule_list = []
+    visited_set = set()
+    for root in self.predict_rule_list:
+      if root in visited_set:
+        continue
+      visited_set.add(root)
+      stack = [(root, iter(dependency_table[root]))]
+      while stack:
+        predict_rule, dependency_iter = stack[-1]
+        for B in dependency_iter:
+          if B not in visited_set:
+            visited_set.add(B)
+            stack.append((B, iter(dependency_table[B])))
+            break
+        else:
+          stack.pop()
+          sorted_rule_list.append(predict_rule)
+    return sorted_rule_list
 
   def GetFirstSetOfSententialForm_(self, right_hand_side, index):
-    if index == len(right_hand_side):
-      return set([Empty])
-
-    item = right_hand_side[index]
-
-    if issubclass(item, Terminal):
-      return set([item])
-
+    # Add the FIRST_set of every item until one which could not derive Empty.
+    # If every item could derive Empty, so does the sentential form.
     first_set = set()
-    for element in self.FIRST_set[item]:
-      if element == Empty:
-        first_set |= self.GetFirstSetOfSententialForm_(right_hand_side, index+1)
-      else:
-        first_set.add(element)
+    for item in right_hand_side[index:]:
+      if issubclass(item, Terminal):
+        first_set.add(item)
+        break
 
+      first_set |= self.FIRST_set[item]
+      first_set.discard(Empty)
+      if Empty not in self.FIRST_set[item]:
+        break
+    else:
+      first_set.add(Empty)
     return first_set
 
-  def MakeFollowSetFromRightHandSide_(self, A, right_hand_side):
-    # Whenever a right-hand-side contains a non-terminal, such as A -> ...By, we
-    # add all the terminals from FIRST_set(y) to FOLLOW_set(B), since these
-    # terminals can follow B. In addition, if y derives Empty, we add all
-    # terminals from FOLLOW_set(A) to FOLLOW_set(B).
-    for index, B in enumerate(right_hand_side):
-      if issubclass(B, Terminal):
-        continue
-
-      first_set = self.GetFirstSetOfSententialForm_(right_hand_side, index+1)
-      for element in first_set:
-        if element == Empty:
-          self.FOLLOW_set[B] |= self.FOLLOW_set[A]
-
-        else:
-          self.FOLLOW_set[B].add(element)
-
   def ComputeFollowSet_(self):
     # Initialize the FOLLOW_set to empty.
     for predict_rule in self.predict_rule_list:
@@ -202,18 +385,42 @@ class Parser(object):
     # END_OF_INPUT is in FOLLOW_set of Start rule.
     self.FOLLOW_set[self.predict_rule_list[0]].add(END_OF_INPUT)
 
-    # Iterate to add Terminal to FOLLOW_set.
-    old_count = 0
-    while True:
-      for predict_rule in self.predict_rule_list:
-        for right_hand_side in predict_rule.right_hand_side_list:
-          self.MakeFollowSetFromRightHandSide_(predict_rule, right_hand_side)
-
-      new_count = sum([len(x) for x in self.FOLLOW_set.values()])
-      if new_count != old_count:
-        old_count = new_count
-      else:
-        break
+    # Whenever a right-hand-side contains a non-terminal, such as A -> ...By, we
+    # add all the terminals from FIRST_set(y) to FOLLOW_set(B), since these
+    # terminals can follow B. In addition, if y derives Empty, every terminal
+    # of FOLLOW_set(A) is in FOLLOW_set(B), which is recorded as an edge from
+    # A to B.
+    edge_table = dict((predict_rule, set())
+                      for predict_rule in self.predict_rule_list)
+    for A in self.predict_rule_list:
+      for right_hand_side in self.right_hand_side_table[A]:
+        for index, B in enumerate(right_hand_side):
+          if issubclass(B, Terminal):
+            continue
+
+          first_set = self.GetFirstSetOfSententialForm_(right_hand_side,
+                                                        index+1)
+          if Empty in first_set:
+            first_set.discard(Empty)
+            if B != A:
+              edge_table[A].add(B)
+          self.FOLLOW_set[B] |= first_set
+
+    # Propagate the FOLLOW_set along the edges, revisiting a rule only when
+    # its FOLLOW_set has grown.
+    work_list = list(self.predict_rule_list)
+    work_set = set(work_list)
+    while work_list:
+      A = work_list.pop()
+      work_set.discard(A)
+
+      for B in edge_table[A]:
+        follow_set = self.FOLLOW_set[B]
+        old_count = len(follow_set)
+        follow_set |= self.FOLLOW_set[A]
+        if len(follow_set) != old_count and B not in work_set:
+          work_list.append(B)
+          work_set.add(B)
 
   def AddEntryToParseTable_(self, predict_rule, terminal, right_hand_side):
     # This parser is greedy, if it can make either an empty prediction or
@@ -232,7 +439,8 @@ class Parser(object):
     # So we fall back to
     #     A = a A-follow
     #     A-follow = a A-follow | epsilon
-    # and this last form is ambiguous without greedy rule.
+    # and this last form is ambiguous without greedy rule. OneOrMore(a) is
+    # compiled into this form.
     if (predict_rule, terminal) not in self.parse_table:
       self.parse_table[(predict_rule, terminal)] = right_hand_side
     elif self.parse_table[(predict_rule, terminal)] == right_hand_side:
@@ -257,7 +465,7 @@ class Parser(object):
     # Empty, we also add alpha to [A, b] entry of the parse table for all the
     # terminal symbol 'b' in FOLLOW_set(A).
     for A in self.predict_rule_list:
-      for alpha in A.right_hand_side_list:
+      for alpha in self.right_hand_side_table[A]:
         for a in self.GetFirstSetOfSententialForm_(alpha, 0):
           if a != Empty:
             self.AddEntryToParseTable_(A, a, alpha)
@@ -265,20 +473,455 @@ class Parser(object):
             for b in self.FOLLOW_set[A]:
               self.AddEntryToParseTable_(A, b, alpha)
 
-  def ValidateTerminalList_(self, terminal_list):
+  def GrammarHash(self):
+    """Return a hash of the grammar, which identifies its cached tables.
+
+    Rules and terminals are identified by their names, so the hash does not
+    change between processes or with the module the grammar is imported as.
+    """
+    grammar = [GRAMMAR_CACHE_VERSION]
+    for predict_rule in self.predict_rule_list:
+      grammar.append([predict_rule.__name__] +
+                     [[item.__name__ for item in right_hand_side]
+                      for right_hand_side in
+                      self.right_hand_side_table[predict_rule]])
+    return hashlib.sha1(json.dumps(grammar).encode('utf-8')).hexdigest()
+
+  def GetSymbolTable_(self):
+    # Return a dict from name to every PredictRule and Terminal of the
+    # grammar, or None when two of them have the same name, in which case the
+    # tables could not be cached by name.
+    symbol_list = (list(self.predict_rule_list) +
+                   list(self.terminal_type_set | set([END_OF_INPUT, Empty])))
+    symbol_table = dict((symbol.__name__, symbol) for symbol in symbol_list)
+    if len(symbol_table) != len(symbol_list):
+      return None
+    return symbol_table
+
+  def LoadGrammarCache_(self, cache_path):
+    # Load the tables from cache_path, return whether they are loaded. A
+    # missing, broken or outdated cache file is the same as no cache file.
+    # 'hash' identifies the grammar, and 'tables_hash' the saved tables, so a
+    # file whose tables were changed or cut short is not used either.
+    if cache_path is None:
+      return False
+
+    symbol_table = self.GetSymbolTable_()
+    if symbol_table is None:
+      return False
+
+    try:
+      with open(cache_path) as cache_file:
+        cache = json.load(cache_file)
+      if cache['hash'] != self.GrammarHash():
+        return False
+      if cache['tables_hash'] != TablesHash_(cache):
+        return False
+
+      FIRST_set = {}
+      FOLLOW_set = {}
+      for predict_rule in self.predict_rule_list:
+        name = predict_rule.__name__
+        FIRST_set[predict_rule] = set(symbol_table[element]
+                                      for element in cache['FIRST_set'][name])
+        FOLLOW_set[predict_rule] = set(
+            symbol_table[element] for element in cache['FOLLOW_set'][name])
+
+      # The parse table refers to a right hand side by its index in the
+      # right_hand_side_list of the predict rule.
+      parse_table = {}
+      for predict_rule, terminal, index in cache['parse_table']:
+        predict_rule = symbol_table[predict_rule]
+        parse_table[(predict_rule, symbol_table[terminal])] = (
+            self.right_hand_side_table[predict_rule][index])
+    except (OSError, ValueError, KeyError, IndexError, TypeError):
+      return False
+
+    self.FIRST_set = FIRST_set
+    self.FOLLOW_set = FOLLOW_set
+    self.parse_table = parse_table
+    return True
+
+  def SaveGrammarCache_(self, cache_path):
+    # Save the tables into cache_path. The cache is only an optimization, so
+    # failing to write it is ignored.
+    if cache_path is None or self.GetSymbolTable_() is None:
+      return
+
+    cache = {
+        'FIRST_set': dict(
+            (predict_rule.__name__,
+             sorted(element.__name__ for element in first_set))
+            for predict_rule, first_set in self.FIRST_set.items()),
+        'FOLLOW_set': dict(
+            (predict_rule.__name__,
+             sorted(element.__name__ for element in follow_set))
+            for predict_rule, follow_set in self.FOLLOW_set.items()),
+        'parse_table': sorted(
+            [predict_rule.__name__,
+             terminal.__name__,
+             IndexOfRightHandSide_(self.right_hand_side_table[predict_rule],
+                                   right_hand_side)]
+            for (predict_rule, terminal), right_hand_side in
+            self.parse_table.items()),
+    }
+    cache['hash'] = self.GrammarHash()
+    cache['tables_hash'] = TablesHash_(cache)
+
+    # Write a temporary file and rename it, so concurrent processes never
+    # read a partially written cache.
+    try:
+      cache_dir = os.path.dirname(os.path.abspath(cache_path))
+      os.makedirs(cache_dir, exist_ok=True)
+      fd, temp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+      try:
+        with os.fdopen(fd, 'w') as temp_file:
+          json.dump(cache, temp_file, sort_keys=True)
+        os.chmod(temp_path, 0o644)
+        os.replace(temp_path, cache_path)
+      except BaseException:
+        os.unlink(temp_path)
+        raise
+    except OSError:
+      pass
+
+  def CompileParseTable_(self):
+    # Every predict rule and terminal is given a small integer id, so Parse
+    # looks up a prediction by indexing a flat list instead of hashing a
+    # tuple of classes.
+    #
+    # Predict rules are symbols 0 .. n_rules-1, in the order of
+    # predict_rule_list, so the ExpressionRule are symbols n_node_rules and
+    # above, and terminals are ids 0 .. n_terminals-1 with
+    # END_OF_INPUT first. The symbol of a terminal is n_rules + its id, so one
+    # comparison tells a terminal from a predict rule on the predict stack.
+    terminal_list = [END_OF_INPUT] + sorted(
+        self.terminal_type_set - set([END_OF_INPUT]),
+        key=lambda terminal: terminal.__name__)
+    n_rules = len(self.predict_rule_list)
+    n_terminals = len(terminal_list)
+
+    self.terminal_id_table = dict(
+        (terminal, terminal_id)
+        for terminal_id, terminal in enumerate(terminal_list))
+    self.symbol_id_table = dict(
+        (predict_rule, rule_id)
+        for rule_id, predict_rule in enumerate(self.predict_rule_list))
+    for terminal, terminal_id in self.terminal_id_table.items():
+      self.symbol_id_table[terminal] = n_rules + terminal_id
+
+    # Each entry is None for a syntax error, or a tuple of the symbols of the
+    # right hand side in reverse order, the order they are pushed onto the
+    # symbol stack. A right hand side usually fills many entries, so its entry
+    # is built once and shared.
+    self.dense_parse_table = [None] * (n_rules * n_terminals)
+    entry_table = {}
+    for (predict_rule, terminal), right_hand_side in self.parse_table.items():
+      entry = entry_table.get(id(right_hand_side))
+      if entry is None:
+        entry = tuple(self.symbol_id_table[child_type]
+                      for child_type in reversed(right_hand_side))
+        entry_table[id(right_hand_side)] = entry
+      self.dense_parse_table[
+          self.symbol_id_table[predict_rule] * n_terminals +
+          self.terminal_id_table[terminal]] = entry
+
+  def GenerateModule(self):
+    """Generate the source of a predictive parser module for the grammar.
+
+    The module has one function per predict rule, which picks the right hand
+    side by the lookahead and checks the terminals inline, instead of the
+    generic table driven loop of Parse. A right hand side ending with a
+    predict rule continues into it without recursion, so repeated structures
+    written as right recursive rules do not grow the Python stack.
+
+    The module is bound to the rule and terminal classes by
+    UseGeneratedModule, which also checks the grammar has not changed since.
+
+    Returns:
+      The Python source of the module.
+
+    Raises:
+      Error: when the names of the rules and terminals could not be used in
+          the generated module.
+    """
+    symbol_table = self.GetSymbolTable_()
+    if symbol_table is None:
+      raise Error('Rules and terminals must have unique names.')
+    for name in symbol_table:
+      if not name.isidentifier():
+        raise Error('%s is not a valid identifier.' % name)
+
+    terminal_list = sorted(self.terminal_type_set - set([END_OF_INPUT]),
+                           key=lambda terminal: terminal.__name__)
+
+    def Symbol(symbol):
+      if symbol == END_OF_INPUT:
+        return 'END_OF_INPUT'
+      elif issubclass(symbol, Terminal):
+        return 'T_%s' % symbol.__name__
+      return 'R_%s' % symbol.__name__
+
+    def Function(predict_rule):
+      return 'Parse_%s' % predict_rule.__name__
+
+    line_list = [
+        '# Generated by ll1.Parser.GenerateModule, do not edit.',
+        '#',
+        '# A predictive parser with one function per predict rule. Bind it to',
+        '# the grammar with ll1.Parser.UseGeneratedModule.',
+        '',
+        "GRAMMAR_HASH = '%s'" % self.GrammarHash(),
+        '',
+        '',
+        'def CreateParse(symbol_table, Error, END_OF_INPUT):',
+        '  """Return the Parse function, see ll1.Parser.Parse."""',
+    ]
+    for predict_rule in self.predict_rule_list:
+      line_list.append("  %s = symbol_table['%s']" % (
+          Symbol(predict_rule), predict_rule.__name__))
     for terminal in terminal_list:
-      if terminal.__class__ not in self.terminal_type_set:
-        raise Error("The type of terminal %s is not defined in grammar." %
-                    terminal)
+      line_list.append("  %s = symbol_table['%s']" % (
+          Symbol(terminal), terminal.__name__))
+    line_list.append('  terminal_type_set = frozenset([%s])' % ', '.join(
+        Symbol(terminal) for terminal in terminal_list))
 
-    terminal_list.append(END_OF_INPUT())
+    # The alternative table of every predict rule maps the lookahead to the
+    # index of the right hand side.
+    for predict_rule in self.predict_rule_list:
+      entry_list = sorted(
+          (terminal.__name__, Symbol(terminal),
+           IndexOfRightHandSide_(self.right_hand_side_table[predict_rule],
+                                 right_hand_side))
+          for (A, terminal), right_hand_side in self.parse_table.items()
+          if A == predict_rule)
+      line_list.append('  table_%s = {%s}' % (
+          predict_rule.__name__,
+          ', '.join('%s: %d' % (symbol, index)
+                    for name, symbol, index in entry_list)))
+
+    line_list.extend([
+        '',
+        '  def Parse(terminal_list):',
+        '    terminal_iter = iter(terminal_list)',
+        '    analysis_stack = []',
+        '    terminal = None',
+        '    terminal_type = None',
+        '',
+        '    def NextTerminal():',
+        '      nonlocal terminal, terminal_type',
+        '      terminal = next(terminal_iter, None)',
+        '      if terminal is None:',
+        '        terminal = END_OF_INPUT()',
+        '        terminal_type = END_OF_INPUT',
+        '      else:',
+        '        terminal_type = terminal.__class__',
+        '        if terminal_type not in terminal_type_set:',
+        '          raise Error("The type of terminal %s is not defined in "',
+        '                      "grammar." % terminal)',
+    ])
+    for predict_rule in self.predict_rule_list:
+      line_list.extend(self.GenerateRuleFunction_(predict_rule, Symbol,
+                                                  Function))
+    line_list.extend([
+        '',
+        '    NextTerminal()',
+        '    call = (%s, %s())' % (Function(self.predict_rule_list[0]),
+                                   Symbol(self.predict_rule_list[0])),
+        '    while call is not None:',
+        '      call = call[0](call[1])',
+        '    if terminal_type is not END_OF_INPUT:',
+        '      raise Error("Fail to parse at terminal: %s" % terminal)',
+        '    return analysis_stack',
+        '',
+        '  return Parse',
+        '',
+    ])
+    return '\n'.join(line_list)
+
+  def GenerateRuleFunction_(self, predict_rule, Symbol, Function):
+    # The function parses an instance of predict_rule and returns None, or
+    # (function, item) to continue with when the right hand side ends with a
+    # predict rule. Ending with the same rule loops in the function.
+    #
+    # The function of an ExpressionRule is called with the predict rule to
+    # parse the children into, instead of a new instance.
+    is_expression_rule = issubclass(predict_rule, ExpressionRule)
+    line_list = [
+        '',
+        '    def %s(item):' % Function(predict_rule),
+        '      while True:',
+    ]
+    if not is_expression_rule:
+      line_list.append('        analysis_stack.append(item)')
+    line_list.append('        alternative = table_%s.get(terminal_type)' % (
+        predict_rule.__name__))
+    keyword = 'if'
+    for index, right_hand_side in enumerate(
+        self.right_hand_side_table[predict_rule]):
+      if not any(value is right_hand_side
+                 for value in self.parse_table.values()):
+        continue
+
+      line_list.append('        %s alternative == %d:' % (keyword, index))
+      keyword = 'elif'
+      if not right_hand_side:
+        line_list.append('          return None')
+        continue
+
+      # The children are created and appended in order, the same as Parse.
+      # The index of a child is only known when parsing once an ExpressionRule
+      # could have added children before it.
+      line_list.append('          children = item.children')
+      children_index_known = not is_expression_rule
+      for child_index, child_type in enumerate(right_hand_side):
+        if issubclass(child_type, Terminal):
+          line_list.extend([
+              '          if terminal_type is not %s:' % Symbol(child_type),
+              '            raise Error("Fail to parse at terminal: %s" % '
+              'terminal)',
+              '          children.append(terminal)',
+              '          analysis_stack.append(terminal)',
+              '          NextTerminal()',
+          ])
+          continue
+
+        if issubclass(child_type, ExpressionRule):
+          children_index_known = False
+          if child_index < len(right_hand_side) - 1:
+            line_list.extend([
+                '          call = %s(item)' % Function(child_type),
+                '          while call is not None:',
+                '            call = call[0](call[1])',
+            ])
+          elif child_type == predict_rule:
+            line_list.append('          continue')
+          else:
+            line_list.append('          return (%s, item)' % (
+                Function(child_type)))
+          continue
+
+        line_list.extend([
+            '          child = %s()' % Symbol(child_type),
+            '          child.parent = item',
+            '          child.children_index = %s' % (
+                child_index if children_index_known else 'len(children)'),
+            '          children.append(child)',
+        ])
+        if child_index < len(right_hand_side) - 1:
+          line_list.extend([
+              '          call = %s(child)' % Function(child_type),
+              '          while call is not None:',
+              '            call = call[0](call[1])',
+          ])
+        elif child_type == predict_rule:
+          line_list.extend([
+              '          item = child',
+              '          continue',
+          ])
+        else:
+          line_list.append('          return (%s, child)' %
+                           Function(child_type))
+
+      if issubclass(right_hand_side[-1], Terminal):
+        line_list.append('          return None')
+
+    line_list.append('        raise Error("Fail to parse at terminal: %s" % '
+                     'terminal)')
+    return line_list
+
+  def UseGeneratedModule(self, module):
+    """Parse with a module generated by GenerateModule.
+
+    Args:
+      module: the imported generated module.
+
+    Raises:
+      Error: when the module was generated from another grammar.
+    """
+    if module.GRAMMAR_HASH != self.GrammarHash():
+      raise Error('The generated module %s is out of date with the grammar.' %
+                  module.__name__)
+    self.generated_parse = module.CreateParse(self.GetSymbolTable_(), Error,
+                                              END_OF_INPUT)
+
+  def NextTerminal_(self, terminal_iter):
+    # Validate the terminal as soon as it is read, and convert the end of the
+    # input into END_OF_INPUT. Return the terminal and its id.
+    terminal = next(terminal_iter, None)
+    if terminal is None:
+      return END_OF_INPUT(), 0
+
+    # END_OF_INPUT only ends the input, it is not a terminal of the input.
+    terminal_id = self.terminal_id_table.get(terminal.__class__)
+    if terminal_id is None or terminal_id == 0:
+      raise Error("The type of terminal %s is not defined in grammar." %
+                  terminal)
+    return terminal, terminal_id
+
+  def Recognize(self, terminal_list):
+    """Check whether the terminal list could be parsed, without parsing it.
+
+    Runs the same prediction as Parse on a stack of symbol ids, so no node
+    of the tree is created and the terminals are not changed.
+
+    Args:
+      terminal_list: an iterable of terminal, see Parse.
+
+    Returns:
+      None if the terminal list could be parsed, otherwise the first terminal
+      failing to parse, which is an END_OF_INPUT if the input ends too early.
+    """
+    terminal_iter = iter(terminal_list)
+    terminal_id_table = self.terminal_id_table
+    dense_parse_table = self.dense_parse_table
+    n_rules = len(self.predict_rule_list)
+    n_terminals = len(terminal_id_table)
+
+    # The id of a terminal which is not defined in the grammar is None. So is
+    # the id of an END_OF_INPUT in the input, whose id 0 only ends the input.
+    symbol_stack = [n_rules, 0]
+    terminal = next(terminal_iter, None)
+    terminal_id = 0 if terminal is None else (
+        terminal_id_table.get(terminal.__class__) or None)
+    while terminal_id is not None:
+      symbol = symbol_stack.pop()
+
+      # Match a terminal.
+      if symbol >= n_rules:
+        if symbol - n_rules != terminal_id:
+          break
+        if terminal_id == 0:
+          return None
+
+        terminal = next(terminal_iter, None)
+        terminal_id = 0 if terminal is None else (
+            terminal_id_table.get(terminal.__class__) or None)
+
+      # Match a predict rule.
+      else:
+        entry = dense_parse_table[symbol * n_terminals + terminal_id]
+        if entry is None:
+          break
+        symbol_stack.extend(entry)
+
+    if terminal is None:
+      return END_OF_INPUT()
+    return terminal
 
-  def Parse(self, terminal_list):
+  def Parse(self, terminal_list, instrument=None):
     """Parse the terminal list.
 
+    Terminals are read one at a time as the lookahead, so terminal_list could
+    be a generator, for example lexer.tokenize_iter, and tokenizing and
+    parsing overlap.
+
     Args:
-      terminal_list: a list of terminal. Each termianl is an instance of
+      terminal_list: an iterable of terminal. Each termianl is an instance of
           subclass of Terminal.
+      instrument: an optional ParseInstrument, which is told every prediction
+          and match. The table driven loop is always used with an instrument,
+          even if a generated module is used otherwise.
 
     Returns:
       The analysis stack if parsing is successful.
@@ -286,57 +929,333 @@ class Parser(object):
     Raises:
       Error: when parsing fails.
     """
-    self.ValidateTerminalList_(terminal_list)
+    if instrument is None and self.generated_parse is not None:
+      return self.generated_parse(terminal_list)
+
+    terminal_iter = iter(terminal_list)
+    predict_rule_list = self.predict_rule_list
+    dense_parse_table = self.dense_parse_table
+    n_rules = len(predict_rule_list)
+    n_node_rules = self.n_node_rules
+    n_terminals = len(self.terminal_id_table)
 
-    # analysis_stack stores the first item first, but predict_stack stores
+    # analysis_stack stores the first item first, but symbol_stack stores
     # the first item last. Python list does not support efficient operations
-    # from the head of the list.
-    predict_stack = [END_OF_INPUT(), self.predict_rule_list[0]()]
+    # from the head of the list. parent_stack holds the predict rule whose
+    # children every symbol in symbol_stack is parsed into.
+    #
+    # Children are filled from left to right, so a predict rule is only
+    # created when it is parsed, and a terminal is appended to the children
+    # of its parent as it is matched, without any placeholder. An
+    # ExpressionRule is parsed into its parent.
+    symbol_stack = [n_rules, 0]
+    parent_stack = [None, None]
     analysis_stack = []
 
-    terminal_index = 0
-    terminal = terminal_list[terminal_index]
+    terminal, terminal_id = self.NextTerminal_(terminal_iter)
     while True:
-      item = predict_stack.pop()
+      symbol = symbol_stack.pop()
+      parent = parent_stack.pop()
 
       # Match a terminal.
-      if isinstance(item, Terminal):
-        if terminal.__class__ == item.__class__:
-          if terminal.__class__ == END_OF_INPUT:
-            assert len(predict_stack) == 0
-            assert terminal_index == len(terminal_list) - 1
+      if symbol >= n_rules:
+        if symbol - n_rules == terminal_id:
+          if terminal_id == 0:
+            assert len(symbol_stack) == 0
             break
 
-          item.parent.children[item.children_index] = terminal
+          parent.children.append(terminal)
           analysis_stack.append(terminal)
-          terminal_index += 1
-          assert terminal_index < len(terminal_list)
-          terminal = terminal_list[terminal_index]
+          if instrument is not None:
+            instrument.Match(terminal)
+          terminal, terminal_id = self.NextTerminal_(terminal_iter)
         else:
           raise Error("Fail to parse at terminal: %s" % terminal)
 
-      # Match a predict rule.
-      elif isinstance(item, PredictRule):
-        try:
-          right_hand_side = self.parse_table[(item.__class__,
-                                              terminal.__class__)]
-          assert len(item.children) == 0
-          for index, child_type in enumerate(right_hand_side):
-            child = child_type()
-            child.parent = item
-            child.children_index = index
-            item.children.append(child)
-
-          predict_stack.extend(reversed(item.children))
-          analysis_stack.append(item)
-        except KeyError:
-          raise Error("Fail to parse at terminal: %s" % terminal)
+      # Match a predict rule. This is Expand_, inlined since the call costs
+      # more than the rest of the prediction.
       else:
-        assert False, ("Invalid item in predict_stack, neither a Terminal "
-                       "nor a PredictRule, %s" % item)
+        entry = dense_parse_table[symbol * n_terminals + terminal_id]
+        if entry is None:
+          raise Error("Fail to parse at terminal: %s" % terminal)
+
+        if symbol < n_node_rules:
+          item = predict_rule_list[symbol]()
+          if parent is not None:
+            item.parent = parent
+            item.children_index = len(parent.children)
+            parent.children.append(item)
+          analysis_stack.append(item)
+        else:
+          item = parent
+
+        symbol_stack.extend(entry)
+        parent_stack.extend([item] * len(entry))
+        if instrument is not None:
+          instrument.Predict(predict_rule_list[symbol], terminal.__class__,
+                             len(symbol_stack))
 
     return analysis_stack
 
+  def Expand_(self, symbol, parent, terminal, terminal_id):
+    # Predict the predict rule of symbol with the lookahead terminal, and
+    # return the predict rule its right hand side is parsed into, with the
+    # entry of the parse table, the symbols of the right hand side in reverse.
+    # The predict rule is a new child of parent, or parent itself for an
+    # ExpressionRule.
+    entry = self.dense_parse_table[
+        symbol * len(self.terminal_id_table) + terminal_id]
+    if entry is None:
+      raise Error("Fail to parse at terminal: %s" % terminal)
+    if symbol >= self.n_node_rules:
+      return parent, entry
+
+    item = self.predict_rule_list[symbol]()
+    if parent is not None:
+      item.parent = parent
+      item.children_index = len(parent.children)
+      parent.children.append(item)
+    return item, entry
+
+
+class ParseInstrument(object):
+  """Receives the events of Parser.Parse, see ParseStatistics.
+
+  Subclasses override the events they are interested in.
+  """
+
+  def Predict(self, predict_rule, terminal_type, stack_depth):
+    """Called when predict_rule is expanded with lookahead of terminal_type.
+
+    stack_depth is the size of the predict stack after the expansion.
+    """
+
+  def Match(self, terminal):
+    """Called when terminal is matched."""
+
+
+class ParseStatistics(ParseInstrument):
+  """Count the predictions and matches of parsing, to find the hot rules.
+
+  Usage:
+    statistics = ParseStatistics()
+    parser.Parse(terminal_list, statistics)
+    statistics.PrintTable()
+  """
+
+  def __init__(self):
+    # Key is (PredictRule, terminal type), value is the number of times the
+    # predict rule is expanded with the terminal as the lookahead.
+    self.prediction_count_table = collections.Counter()
+
+    # Key is terminal type, value is the number of terminals matched.
+    self.match_count_table = collections.Counter()
+
+    self.max_stack_depth = 0
+
+  def Predict(self, predict_rule, terminal_type, stack_depth):
+    self.prediction_count_table[(predict_rule, terminal_type)] += 1
+    if stack_depth > self.max_stack_depth:
+      self.max_stack_depth = stack_depth
+
+  def Match(self, terminal):
+    self.match_count_table[terminal.__class__] += 1
+
+  def ToDict(self):
+    """Return the statistics as a dict which could be dumped as JSON."""
+    return {
+        'prediction_count': sum(self.prediction_count_table.values()),
+        'match_count': sum(self.match_count_table.values()),
+        'max_stack_depth': self.max_stack_depth,
+        'predictions': [
+            {'rule': predict_rule.__name__,
+             'lookahead': terminal_type.__name__,
+             'count': count}
+            for (predict_rule, terminal_type), count in
+            self.prediction_count_table.most_common()],
+        'matches': dict((terminal_type.__name__, count)
+                        for terminal_type, count in
+                        self.match_count_table.most_common()),
+    }
+
+  def ToJson(self):
+    return json.dumps(self.ToDict(), indent=2)
+
+  def PrintTable(self):
+    """Print the statistics, the most frequent first."""
+    print('='*20, 'Predictions', '='*20)
+    for (predict_rule, terminal_type), count in (
+        self.prediction_count_table.most_common()):
+      print('%10d  %s, %s' % (count, predict_rule.__name__,
+                              terminal_type.__name__))
+    print()
+
+    print('='*20, 'Matches', '='*20)
+    for terminal_type, count in self.match_count_table.most_common():
+      print('%10d  %s' % (count, terminal_type.__name__))
+    print()
+
+    print('%d predictions, %d matches, max stack depth %d' % (
+        sum(self.prediction_count_table.values()),
+        sum(self.match_count_table.values()),
+        self.max_stack_depth))
+
+
+class ParseSession(object):
+  """An incremental parse, which is fed one terminal at a time.
+
+  The predict stack is kept between calls, so terminals could be fed as they
+  are produced, for example by a streaming lexer or a network read. Every
+  predict rule is reported as soon as its subtree is complete, children
+  before their parents, so the tree could be processed before the whole input
+  has arrived.
+
+  A predict rule whose last child is a predict rule is completed together
+  with that child: once the child is reported, its ancestors completed with
+  it are reported through 'parent'. So right recursive rules, like lists, do
+  not grow the predict stack. If on_complete deletes the 'parent' of a rule,
+  its ancestors are not reported, which lets a caller drop the finished part
+  of a long right recursion. Repetitions, see ZeroOrMore, are parsed into one
+  predict rule, whose finished children could be dropped from its children.
+
+  Usage:
+    session = ParseSession(parser, on_complete)
+    for terminal in terminal_iter:
+      session.feed(terminal)
+    root = session.finish()
+  """
+
+  # Symbol of the marker pushed below the children of a predict rule, which
+  # is popped when all the children are complete. A marker of
+  # COMPLETE_MARKER - n also completes n ancestors of the predict rule.
+  COMPLETE_MARKER = -1
+
+  def __init__(self, parser, on_complete=None):
+    """Start a parse session.
+
+    Args:
+      parser: the Parser of the grammar.
+      on_complete: an optional function called with every predict rule once
+          its subtree is complete.
+    """
+    self.parser = parser
+    self.on_complete = on_complete
+    self.n_rules = len(parser.predict_rule_list)
+
+    # The same stacks as Parser.Parse, see there.
+    self.symbol_stack = [self.n_rules, 0]
+    self.parent_stack = [None, None]
+
+    # The start predict rule, once it is predicted.
+    self.root = None
+    self.finished = False
+
+  def feed(self, terminal):
+    """Parse the next terminal.
+
+    Raises:
+      Error: when parsing fails, after which the session could not be used.
+    """
+    terminal_id = self.parser.terminal_id_table.get(terminal.__class__)
+    if terminal_id is None or terminal_id == 0:
+      raise Error("The type of terminal %s is not defined in grammar." %
+                  terminal)
+    self.Match_(terminal, terminal_id)
+
+  def finish(self):
+    """End the input, and return the start predict rule.
+
+    Raises:
+      Error: when the input ends too early.
+    """
+    self.Match_(END_OF_INPUT(), 0)
+    return self.root
+
+  def Match_(self, terminal, terminal_id):
+    # Predict until terminal is matched.
+    if self.finished:
+      raise Error("The parse session is finished.")
+
+    symbol_stack = self.symbol_stack
+    parent_stack = self.parent_stack
+    n_rules = self.n_rules
+    while True:
+      symbol = symbol_stack.pop()
+      parent = parent_stack.pop()
+
+      if symbol <= self.COMPLETE_MARKER:
+        self.Complete_(parent, self.COMPLETE_MARKER - symbol)
+
+      # Match a terminal.
+      elif symbol >= n_rules:
+        if symbol - n_rules != terminal_id:
+          raise Error("Fail to parse at terminal: %s" % terminal)
+        if terminal_id == 0:
+          assert len(symbol_stack) == 0
+          self.finished = True
+          return
+
+        parent.children.append(terminal)
+        break
+
+      # Match a predict rule.
+      else:
+        item, entry = self.parser.Expand_(symbol, parent, terminal,
+                                          terminal_id)
+
+        # An ExpressionRule is parsed into parent, and has no marker.
+        if item is parent:
+          symbol_stack.extend(entry)
+          parent_stack.extend([parent] * len(entry))
+          continue
+        if parent is None:
+          self.root = item
+
+        # If the marker of parent is on the top, item is its last child, so
+        # the marker is merged into the one of item.
+        marker = self.COMPLETE_MARKER
+        if symbol_stack[-1] <= self.COMPLETE_MARKER:
+          assert parent_stack[-1] is parent
+          marker = symbol_stack.pop() - 1
+          parent_stack.pop()
+        symbol_stack.append(marker)
+        parent_stack.append(item)
+        symbol_stack.extend(entry)
+        parent_stack.extend([item] * len(entry))
+
+    # Report the predict rules completed by terminal without waiting for the
+    # next terminal.
+    while symbol_stack[-1] <= self.COMPLETE_MARKER:
+      symbol = symbol_stack.pop()
+      self.Complete_(parent_stack.pop(), self.COMPLETE_MARKER - symbol)
+
+  def Complete_(self, item, ancestor_count):
+    # Report item, then ancestor_count of its ancestors.
+    if self.on_complete is None:
+      return
+    for i in range(ancestor_count + 1):
+      self.on_complete(item)
+      if i < ancestor_count:
+        item = getattr(item, 'parent', None)
+        if item is None:
+          break
+
+
+def TablesHash_(cache):
+  # Return a hash of the tables in a grammar cache.
+  tables = dict((name, cache[name]) for name in GRAMMAR_CACHE_TABLE_LIST)
+  return hashlib.sha1(
+      json.dumps(tables, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def IndexOfRightHandSide_(right_hand_side_list, right_hand_side):
+  # The parse table holds the right hand side lists themselves, so look them
+  # up by identity.
+  for index, item in enumerate(right_hand_side_list):
+    if item is right_hand_side:
+      return index
+  raise ValueError(right_hand_side)
+
 
 if __name__ == '__main__':
   pass
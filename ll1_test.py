@@ -0,0 +1,336 @@
+#!/usr/bin/python3
+#
+# Test routines for ll1. To run this test, in this directory, run
+# python3 ll1_test.py
+
+import json
+import os
+import tempfile
+
+import ll1
+
+
+class A(ll1.Terminal): pass
+class B(ll1.Terminal): pass
+class C(ll1.Terminal): pass
+class UNKNOWN(ll1.Terminal): pass
+
+TERMINAL_TYPE_TABLE = {'a': A, 'b': B, 'c': C}
+
+
+def Terminals(string):
+  return [TERMINAL_TYPE_TABLE[letter]() for letter in string]
+
+
+# pair -> a pair b | c
+class pair(ll1.PredictRule):
+  pass
+pair.right_hand_side_list = [
+    [A, pair, B],
+    [C],
+    ]
+
+pair_parser = ll1.Parser([pair])
+
+analysis_stack = pair_parser.Parse(Terminals('aacbb'))
+if not([type(item) for item in analysis_stack] ==
+       [pair, A, pair, A, pair, C, B, B]):
+  raise Exception(analysis_stack)
+
+# An instrument is told every prediction and match of the same parse.
+statistics = ll1.ParseStatistics()
+analysis_stack = pair_parser.Parse(Terminals('aacbb'), statistics)
+if not([type(item) for item in analysis_stack] ==
+       [pair, A, pair, A, pair, C, B, B] and
+       statistics.prediction_count_table == {(pair, A): 2, (pair, C): 1} and
+       statistics.match_count_table == {A: 2, B: 2, C: 1} and
+       statistics.max_stack_depth == 5):
+  raise Exception(statistics.ToJson())
+
+# END_OF_INPUT ends the input, so it is not accepted in the input, which
+# would drop the terminals after it.
+for terminal_list in [Terminals('c') + [ll1.END_OF_INPUT()] + Terminals('b'),
+                      Terminals('acb') + [ll1.END_OF_INPUT()]]:
+  try:
+    pair_parser.Parse(terminal_list)
+    raise Exception(terminal_list)
+  except ll1.Error:
+    pass
+
+  failure = pair_parser.Recognize(terminal_list)
+  if not(type(failure) == ll1.END_OF_INPUT and
+         failure is terminal_list[-1 if len(terminal_list) == 4 else 1]):
+    raise Exception(failure)
+
+# Recognize accepts the same terminals as Parse, without building the tree,
+# and returns the first terminal failing to parse.
+if not(pair_parser.Recognize(Terminals('aacbb')) is None and
+       pair_parser.Recognize(iter(Terminals('c'))) is None):
+  raise Exception('Recognize')
+
+terminal_list = Terminals('aacbc')
+if not(pair_parser.Recognize(terminal_list) is terminal_list[4]):
+  raise Exception(terminal_list)
+
+# The input ends too early.
+if not(type(pair_parser.Recognize(Terminals('aacb'))) == ll1.END_OF_INPUT):
+  raise Exception('Recognize')
+
+# A terminal type not defined in the grammar.
+terminal_list = Terminals('a') + [UNKNOWN()] + Terminals('cb')
+if not(pair_parser.Recognize(terminal_list) is terminal_list[1]):
+  raise Exception(terminal_list)
+try:
+  pair_parser.Parse(terminal_list)
+  raise Exception(terminal_list)
+except ll1.Error:
+  pass
+
+
+# item_list -> item item_list | []
+# item -> a | b c
+class item(ll1.PredictRule):
+  pass
+item.right_hand_side_list = [
+    [A],
+    [B, C],
+    ]
+
+class item_list(ll1.PredictRule):
+  pass
+item_list.right_hand_side_list = [
+    [item, item_list],
+    [],
+    ]
+
+item_list_parser = ll1.Parser([item_list, item])
+
+
+def PostOrder(root):
+  # The predict rules of the tree, children before their parents.
+  rule_list = []
+  stack = [(root, False)]
+  while stack:
+    node, visited = stack.pop()
+    if visited:
+      rule_list.append(node)
+    elif isinstance(node, ll1.PredictRule):
+      stack.append((node, True))
+      stack.extend((child, False) for child in reversed(node.children))
+  return rule_list
+
+
+# ParseSession builds the same tree as Parse, one terminal at a time, and
+# reports every predict rule as soon as it is complete, children first.
+completed_list = []
+session = ll1.ParseSession(pair_parser, completed_list.append)
+for terminal in Terminals('aac'):
+  session.feed(terminal)
+if not([type(rule) for rule in completed_list] == [pair]):
+  raise Exception(completed_list)
+session.feed(B())
+if not(len(completed_list) == 2):
+  raise Exception(completed_list)
+session.feed(B())
+root = session.finish()
+if not(completed_list == PostOrder(root) and
+       [type(item) for item in PostOrder(root)] == [pair] * 3 and
+       [type(child) for child in root.children] == [A, pair, B]):
+  raise Exception(completed_list)
+
+# A right recursive rule is completed together with its last child, whose
+# markers are merged, so the predict stack does not grow with the list.
+completed_list = []
+session = ll1.ParseSession(item_list_parser, completed_list.append)
+max_stack_depth = 0
+for terminal in Terminals('a' + 'bc' * 1000):
+  session.feed(terminal)
+  max_stack_depth = max(max_stack_depth, len(session.symbol_stack))
+  if not(type(completed_list[-1]) == item):
+    raise Exception(completed_list[-1])
+root = session.finish()
+if not(max_stack_depth <= 6 and
+       completed_list == PostOrder(root) and
+       len(completed_list) == 2 * 1001 + 1):
+  raise Exception((max_stack_depth, len(completed_list)))
+
+expected_list = [type(node) for node in PostOrder(
+    item_list_parser.Parse(Terminals('a' + 'bc' * 1000))[0])]
+if not([type(node) for node in completed_list] == expected_list):
+  raise Exception(completed_list)
+
+# Deleting the parent of a completed rule stops reporting its ancestors.
+completed_list = []
+def OnComplete(rule):
+  completed_list.append(rule)
+  if type(rule) == item_list and hasattr(rule, 'parent'):
+    del rule.parent
+session = ll1.ParseSession(item_list_parser, OnComplete)
+for terminal in Terminals('abc'):
+  session.feed(terminal)
+session.finish()
+if not([type(rule) for rule in completed_list] == [item, item, item_list]):
+  raise Exception(completed_list)
+
+# END_OF_INPUT is only fed by finish, and a finished session is done.
+session = ll1.ParseSession(pair_parser)
+for terminal in [ll1.END_OF_INPUT(), UNKNOWN(), B()]:
+  try:
+    session.feed(terminal)
+    raise Exception(terminal)
+  except ll1.Error:
+    pass
+session = ll1.ParseSession(pair_parser)
+session.feed(C())
+session.finish()
+try:
+  session.finish()
+  raise Exception(session)
+except ll1.Error:
+  pass
+
+
+# Expressions are parsed into the predict rule they are in.
+# repetition -> (a b)* [c] (item)+
+class repetition(ll1.PredictRule):
+  pass
+repetition.right_hand_side_list = [
+    [ll1.ZeroOrMore(A, B), ll1.Optional(C), ll1.OneOrMore(item)],
+    ]
+
+repetition_parser = ll1.Parser([repetition, item])
+
+
+def TreeShape(node):
+  # The types of the tree, each predict rule followed by its children.
+  if isinstance(node, ll1.PredictRule):
+    return (type(node), [TreeShape(child) for child in node.children])
+  return type(node)
+
+
+for string, expected_shape in [
+    ('bc', (repetition, [(item, [B, C])])),
+    ('ababbca', (repetition, [A, B, A, B, (item, [B, C]), (item, [A])])),
+    ('abcbc', (repetition, [A, B, C, (item, [B, C])])),
+    ('ca', (repetition, [C, (item, [A])])),
+    ]:
+  analysis_stack = repetition_parser.Parse(Terminals(string))
+  if not(TreeShape(analysis_stack[0]) == expected_shape):
+    raise Exception(string)
+
+# The repetition is greedy, so the 'a' of the first item is taken by (a b)*.
+# OneOrMore needs an item.
+for string in ['a', 'ab', '']:
+  if not(repetition_parser.Recognize(Terminals(string)) is not None):
+    raise Exception(string)
+
+for expression_type in [ll1.Optional, ll1.ZeroOrMore, ll1.OneOrMore]:
+  try:
+    expression_type()
+    raise Exception(expression_type)
+  except ll1.Error as error:
+    if not(str(error) == '%s of no item.' % expression_type.__name__):
+      raise Exception(error)
+
+
+# The FIRST set of an expression takes part in the LL(1) check.
+# conflict -> [a] b | (a)+ c
+class conflict(ll1.PredictRule):
+  pass
+conflict.right_hand_side_list = [
+    [ll1.Optional(A), B],
+    [ll1.OneOrMore(A), C],
+    ]
+
+try:
+  ll1.Parser([conflict])
+  raise Exception(conflict)
+except ll1.Error as error:
+  if not('not LL(1)' in str(error)):
+    raise Exception(error)
+
+
+# A rule is left recursive through a nullable prefix, which an expression
+# could be.
+# left_recursive -> [a] left_recursive b | c
+class left_recursive(ll1.PredictRule):
+  pass
+left_recursive.right_hand_side_list = [
+    [ll1.Optional(A), left_recursive, B],
+    [C],
+    ]
+
+# nullable_loop -> ([a])* b
+class nullable_loop(ll1.PredictRule):
+  pass
+nullable_loop.right_hand_side_list = [
+    [ll1.ZeroOrMore(ll1.Optional(A)), B],
+    ]
+
+for predict_rule in [left_recursive, nullable_loop]:
+  try:
+    ll1.Parser([predict_rule])
+    raise Exception(predict_rule)
+  except ll1.Error as error:
+    if not(str(error).startswith('Left recursive is not allowed.')):
+      raise Exception(error)
+
+
+# The tables are saved into the cache file on the first build, and loaded on
+# the next one. A file which does not match the grammar, or which could not
+# be read or written, is the same as no cache file.
+def SameTables(parser_a, parser_b):
+  return (parser_a.FIRST_set == parser_b.FIRST_set and
+          parser_a.FOLLOW_set == parser_b.FOLLOW_set and
+          parser_a.parse_table == parser_b.parse_table)
+
+
+def ParseTypes(parser, string):
+  return [type(item) for item in parser.Parse(Terminals(string))]
+
+
+with tempfile.TemporaryDirectory() as cache_dir:
+  cache_path = os.path.join(cache_dir, 'grammar.json')
+
+  saved_parser = ll1.Parser([item_list, item], cache_path)
+  if not(os.path.exists(cache_path) and
+         'FIRST_set' in saved_parser.build_time and
+         SameTables(saved_parser, item_list_parser)):
+    raise Exception(saved_parser.build_time)
+
+  loaded_parser = ll1.Parser([item_list, item], cache_path)
+  if not('FIRST_set' not in loaded_parser.build_time and
+         SameTables(loaded_parser, item_list_parser) and
+         ParseTypes(loaded_parser, 'abca') ==
+         ParseTypes(item_list_parser, 'abca')):
+    raise Exception(loaded_parser.build_time)
+
+  # A file of another grammar is ignored and rewritten.
+  pair_cache_parser = ll1.Parser([pair], cache_path)
+  with open(cache_path) as cache_file:
+    cache = json.load(cache_file)
+  if not('FIRST_set' in pair_cache_parser.build_time and
+         cache['hash'] == pair_cache_parser.GrammarHash()):
+    raise Exception(cache)
+
+  # A file of the same grammar whose tables were changed is ignored.
+  cache['parse_table'] = cache['parse_table'][:1]
+  with open(cache_path, 'w') as cache_file:
+    json.dump(cache, cache_file)
+  tampered_parser = ll1.Parser([pair], cache_path)
+  if not('FIRST_set' in tampered_parser.build_time and
+         SameTables(tampered_parser, pair_parser)):
+    raise Exception(tampered_parser.build_time)
+
+  # An invalid file, a path which could not be read, and a path which could
+  # not be written.
+  with open(cache_path, 'w') as cache_file:
+    cache_file.write('{"hash": ')
+  unreadable_path = os.path.join(cache_dir, 'directory')
+  os.mkdir(unreadable_path)
+  unwritable_path = os.path.join(cache_path, 'grammar.json')
+  for path in [cache_path, unreadable_path, unwritable_path]:
+    fallback_parser = ll1.Parser([item_list, item], path)
+    if not('FIRST_set' in fallback_parser.build_time and
+           SameTables(fallback_parser, item_list_parser)):
+      raise Exception(path)
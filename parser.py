@@ -5,11 +5,76 @@
 # Usage:
 #    parser = TwikiParser()
 #    parser.Parser(string)
+#
+# To generate a faster parser module for the grammar, in this directory:
+#    python3 parser.py --generate twiki_parser_generated.py
+# and parse with it:
+#    parser = TwikiParser(generated_module=twiki_parser_generated)
 
+import itertools
 import sys
 
-from . import ll1
-from . import lexer
+# The same imports as lexer, so the tokens are terminals of the same ll1.
+import ll1
+import lexer
+
+
+class HtmlWriter(object):
+  """Write the html of parse trees into one list of fragments.
+
+  Rules never join the html of their children. Every rule lists the parts of
+  its html instead, see PredictRule.HtmlParts, and the writer walks the tree
+  writing the parts in order. So every piece of html is copied once into the
+  fragment list however deep it is in the tree, where joining the html at
+  every level recopies it.
+
+  The writer also numbers the titles in the order they are written, and
+  collects them for the TOC. The TOC lists the titles after it too, so a
+  fragment is reserved for it, which is filled once all the titles are
+  written, see TwikiParser.generate_toc.
+  """
+
+  def __init__(self):
+    self.fragment_list = []
+    # A list of (level, text, anchor_id) of the titles written.
+    self.title_list = []
+    # The indexes of the fragments reserved for the TOCs written.
+    self.toc_index_list = []
+
+  def Write(self, item):
+    """Write the html of a rule or terminal."""
+    fragment_list = self.fragment_list
+    # An explicit stack instead of recursion, since the tree is as deep as
+    # the longest list.
+    part_stack = [item]
+    while part_stack:
+      part = part_stack.pop()
+      if type(part) is str:
+        fragment_list.append(part)
+      elif isinstance(part, ll1.Terminal):
+        fragment_list.append(part.html)
+      else:
+        part_stack.extend(reversed(part.HtmlParts(self)))
+
+  def ReserveToc(self):
+    """Reserve the next fragment for the TOC."""
+    self.toc_index_list.append(len(self.fragment_list))
+    self.fragment_list.append('')
+
+  def Render(self, item):
+    """Return the html of a rule or terminal as a string, without writing it.
+    """
+    fragment_list = self.fragment_list
+    self.fragment_list = []
+    try:
+      self.Write(item)
+      return self.GetValue()
+    finally:
+      self.fragment_list = fragment_list
+
+  def GetValue(self):
+    """Return the html written so far."""
+    return ''.join(self.fragment_list)
 
 
 class PredictRule(ll1.PredictRule):
@@ -17,30 +82,49 @@ class PredictRule(ll1.PredictRule):
 
   Providing basic implemention for HTML generation.
   """
-  def __init__(self):
-    ll1.PredictRule.__init__(self)
-    self.html = ''
+  # Subclasses define __slots__ too, so that predict rules, the bulk of the
+  # tree, have no per-instance __dict__.
+  __slots__ = ()
 
   # This method can be overridden by subclass.
-  def GenerateHtml(self):
-    self.html = "".join([child.html for child in self.children])
+  def HtmlParts(self, writer):
+    """Return the parts of the html of the rule in order.
 
-  def Generate(self):
-    self.GenerateHtml()
+    A part is either a string, or a child whose html is written in its place
+    by the writer.
 
-    # Delete children's 'html' to save memory.
-    # Delete the children does not help since they are still referenced in the
-    # analysis stack.
-    for child in self.children:
-      del child.html
+    Args:
+      writer: the HtmlWriter writing the rule.
+    """
+    return self.children
 
 
 class WhitespaceJoinChildrenRule(PredictRule):
-  def GenerateHtml(self):
-    self.html = " ".join([child.html for child in self.children])
+  __slots__ = ()
+
+  def HtmlParts(self, writer):
+    part_list = []
+    for child in self.children:
+      if part_list:
+        part_list.append(' ')
+      part_list.append(child)
+    return part_list
+
 
+class WordListRule(PredictRule):
+  __slots__ = ()
 
-class plain_word(PredictRule): pass
+  # Every word is followed by a whitespace.
+  def HtmlParts(self, writer):
+    part_list = []
+    for child in self.children:
+      part_list.append(child)
+      part_list.append(' ')
+    return part_list
+
+
+class plain_word(PredictRule):
+  __slots__ = ()
 plain_word.right_hand_side_list = [
     [lexer.WORD],
     [lexer.PUNCTURE],
@@ -48,13 +132,16 @@ plain_word.right_hand_side_list = [
     [lexer.ENDCOLOR],
     ]
 
-class plain_word_list(WhitespaceJoinChildrenRule): pass
-plain_word_list.right_hand_side_list = [
-    [plain_word, plain_word_list],
-    [],
-    ]
+class plain_word_list(WordListRule):
+  __slots__ = ()
+
+  right_hand_side_list = [
+      [ll1.ZeroOrMore(plain_word)],
+      ]
 
 class bold_word(WhitespaceJoinChildrenRule):
+  __slots__ = ()
+
   right_hand_side_list = [
       [
           lexer.BOLD_WORD,
@@ -67,6 +154,8 @@ class bold_word(WhitespaceJoinChildrenRule):
   ]
 
 class italics_word(WhitespaceJoinChildrenRule):
+  __slots__ = ()
+
   right_hand_side_list = [
       [
           lexer.ITALICS_WORD,
@@ -79,6 +168,8 @@ class italics_word(WhitespaceJoinChildrenRule):
   ]
 
 class fixed_width_word(WhitespaceJoinChildrenRule):
+  __slots__ = ()
+
   right_hand_side_list = [
       [
           lexer.FIXED_WIDTH_WORD,
@@ -91,6 +182,8 @@ class fixed_width_word(WhitespaceJoinChildrenRule):
   ]
 
 class long_link(WhitespaceJoinChildrenRule):
+  __slots__ = ()
+
   right_hand_side_list = [
       [
           lexer.LONG_LINK,
@@ -103,6 +196,8 @@ class long_link(WhitespaceJoinChildrenRule):
   ]
 
 class formatted_word(PredictRule):
+  __slots__ = ()
+
   right_hand_side_list = [
       [plain_word],
       [bold_word],
@@ -115,14 +210,17 @@ class formatted_word(PredictRule):
       ]
 
 # TODO: Remove the whitespace before punctures.
-class formatted_word_list(WhitespaceJoinChildrenRule): pass
-formatted_word_list.right_hand_side_list = [
-    [formatted_word, formatted_word_list],
-    [],
-    ]
+class formatted_word_list(WordListRule):
+  __slots__ = ()
+
+  right_hand_side_list = [
+      [ll1.ZeroOrMore(formatted_word)],
+      ]
 
 class line(PredictRule):
-  def GenerateHtml(self):
+  __slots__ = ()
+
+  def HtmlParts(self, writer):
     # If line is empty, generate a paragraph. Notice that we put the ending mark
     # before the opening mark because we have another pair of <p></p> for the
     # whole paragraph.
@@ -130,12 +228,12 @@ class line(PredictRule):
     # As a side effect, we will generate two <p></p><p></p> if a paragraph only
     # has an empty line, but we decide not to fix it since it makes the code
     # more complicated.
-    if len(self.children) == 2 and self.children[0].html.strip() == "":
-      self.html = "\n</p>\n<p>\n"
-    elif len(self.children) == 3 and self.children[1].html.strip() == "":
-      self.html = "\n</p>\n<p>\n"
-    else:
-      self.html = " ".join([child.html for child in self.children])
+    words_html = writer.Render(self.children[-2])
+    if words_html.strip() == "":
+      return ["\n</p>\n<p>\n"]
+    if len(self.children) == 2:
+      return [words_html, " ", self.children[1]]
+    return [self.children[0], " ", words_html, " ", self.children[2]]
 
   right_hand_side_list = [
       [
@@ -149,48 +247,40 @@ class line(PredictRule):
       ],
   ]
 
-class paragraph_follow(PredictRule): pass
-paragraph_follow.right_hand_side_list = [
-    [line, paragraph_follow],
-    [],
-    ]
-
 class paragraph(PredictRule):
-  def GenerateHtml(self):
-    self.html = "<p>\n%s\n%s</p>\n" % (self.children[0].html,
-                                       self.children[1].html)
+  __slots__ = ()
+
+  def HtmlParts(self, writer):
+    return ["<p>\n", self.children[0], "\n"] + self.children[1:] + ["</p>\n"]
 
   right_hand_side_list = [
-      [line, paragraph_follow],
+      [ll1.OneOrMore(line)],
       ]
 
 class TitleBase(PredictRule):
-  # Since we need to generate an unique anchor id for each title in the TOC,
-  # a class variable is used to track this.
-  global_anchor_id = 0
+  # Every title of a document has an unique anchor id for the TOC, which is
+  # numbered by the HtmlWriter in the order of the titles.
+  __slots__ = ()
 
-  def __init__(self):
-    PredictRule.__init__(self)
-    self.anchor_id = TitleBase.global_anchor_id
-    TitleBase.global_anchor_id += 1
-
-  def GenerateHtml(self):
+  def HtmlParts(self, writer):
     # Find level from class name. This is a HACK.
     type_name = str(type(self))
     class_name_start = type_name.find('title')
     assert class_name_start != -1
-    self.level = int(type_name[class_name_start+5:class_name_start+6])
-    self.html = "<h%s><a name=%s>%s</a></h%s>\n" % (
-        self.level,
-        self.anchor_id,
-        self.children[1].html,
-        self.level)
-    self.title_html = self.children[1].html
+    level = int(type_name[class_name_start+5:class_name_start+6])
+    anchor_id = len(writer.title_list)
+    title_html = writer.Render(self.children[1])
+    writer.title_list.append((level, title_html, anchor_id))
+    return ["<h%s><a name=%s>" % (level, anchor_id),
+            title_html,
+            "</a></h%s>\n" % level]
 
 # Use exec to generate all the title classes since they are similar.
 # It is boring to write them all down.
 title_class_template = """\
 class title%(level)s(TitleBase):
+  __slots__ = ()
+
   right_hand_side_list = [
       [lexer.TITLE_LEAD%(level)s, line],
       ]
@@ -198,6 +288,8 @@ class title%(level)s(TitleBase):
 
 title_summary_template = """\
 class title(PredictRule):
+  __slots__ = ()
+
   right_hand_side_list = [
       %s
       ]
@@ -214,106 +306,106 @@ exec(title_summary_template % '\n'.join(title_summary_class_source_list))
 
 
 class toc(PredictRule):
+  __slots__ = ()
+
+  def HtmlParts(self, writer):
+    writer.ReserveToc()
+    return [self.children[1]]
+
   right_hand_side_list = [
       [lexer.TOC, lexer.NEW_LINE],
       ]
 
 
 class ListItem(PredictRule):
-  def GenerateHtml(self):
-    self.html = "<li>%s</li>\n" % "".join(
-        [child.html for child in self.children])
+  __slots__ = ()
+
+  def HtmlParts(self, writer):
+    return ["<li>"] + self.children + ["</li>\n"]
 
 
 class ListBase(PredictRule):
-  def GenerateHtml(self):
+  __slots__ = ()
+
+  def HtmlParts(self, writer):
     type_name = str(type(self.children[0]))
     if type_name.find("unorder_level") != -1:
-      self.html = "\n<ul>\n%s\n</ul>\n" % self.children[0].html
+      return ["\n<ul>\n", self.children[0], "\n</ul>\n"]
     elif type_name.find("order_level") != -1:
-      self.html = "\n<ol>\n%s\n</ol>\n" % self.children[0].html
+      return ["\n<ol>\n", self.children[0], "\n</ol>\n"]
     else:
-      raise Error("Unknown list type: %s" % type_name)
+      raise ll1.Error("Unknown list type: %s" % type_name)
 
 
 # The list in last level does not have next level list as follwup.
 list_class_last_followup_template = """\
 class level%(level)s_list_item_follow(PredictRule):
-  def GenerateHtml(self):
-    if len(self.children) == 0:
-      self.html = ''
-    elif isinstance(self.children[0], lexer.NEW_LINE):
-      self.html = '<p/>' + self.children[1].html
-    else:
-      self.html = "".join([child.html for child in self.children])
+  __slots__ = ()
+
+  def HtmlParts(self, writer):
+    if isinstance(self.children[0], lexer.NEW_LINE):
+      return ['<p/>']
+    return self.children
 
 level%(level)s_list_item_follow.right_hand_side_list = [
-    [lexer.LINE_LEAD_WHITESPACE, line, level%(level)s_list_item_follow],
-    [lexer.NEW_LINE, level%(level)s_list_item_follow],
-    [],
+    [lexer.LINE_LEAD_WHITESPACE, line],
+    [lexer.NEW_LINE],
     ]
 """
 
 list_class_normal_followup_template = """\
 class level%(level)s_list_item_follow(PredictRule):
-  def GenerateHtml(self):
-    if len(self.children) == 0:
-      self.html = ''
-    elif isinstance(self.children[0], lexer.NEW_LINE):
-      self.html = '<p/>' + self.children[1].html
-    else:
-      self.html = "".join([child.html for child in self.children])
+  __slots__ = ()
+
+  def HtmlParts(self, writer):
+    if isinstance(self.children[0], lexer.NEW_LINE):
+      return ['<p/>']
+    return self.children
 
 level%(level)s_list_item_follow.right_hand_side_list = [
-    [lexer.LINE_LEAD_WHITESPACE, line, level%(level)s_list_item_follow],
-    [lexer.NEW_LINE, level%(level)s_list_item_follow],
-    [level%(next_level)s_list, level%(level)s_list_item_follow],
-    [],
+    [lexer.LINE_LEAD_WHITESPACE, line],
+    [lexer.NEW_LINE],
+    [level%(next_level)s_list],
     ]
 """
 
 list_class_template = """\
 class unorder_level%(level)s_list_item(ListItem):
+  __slots__ = ()
+
   right_hand_side_list = [
       [
           lexer.UNORDERED_LIST_LEAD%(level)s,
           line,
-          level%(level)s_list_item_follow,
+          ll1.ZeroOrMore(level%(level)s_list_item_follow),
       ],
   ]
 
-class unorder_level%(level)s_list_follow(PredictRule): pass
-unorder_level%(level)s_list_follow.right_hand_side_list = [
-    [unorder_level%(level)s_list_item, unorder_level%(level)s_list_follow],
-    [],
-    ]
-
-class unorder_level%(level)s_list(PredictRule): pass
+class unorder_level%(level)s_list(PredictRule):
+  __slots__ = ()
 unorder_level%(level)s_list.right_hand_side_list = [
-    [unorder_level%(level)s_list_item, unorder_level%(level)s_list_follow],
+    [ll1.OneOrMore(unorder_level%(level)s_list_item)],
     ]
 
 class order_level%(level)s_list_item(ListItem):
+  __slots__ = ()
+
   right_hand_side_list = [
       [
           lexer.ORDERED_LIST_LEAD%(level)s,
           line,
-          level%(level)s_list_item_follow,
+          ll1.ZeroOrMore(level%(level)s_list_item_follow),
       ],
   ]
 
-class order_level%(level)s_list_follow(PredictRule): pass
-order_level%(level)s_list_follow.right_hand_side_list = [
-    [order_level%(level)s_list_item, order_level%(level)s_list_follow],
-    [],
-    ]
-
-class order_level%(level)s_list(PredictRule): pass
+class order_level%(level)s_list(PredictRule):
+  __slots__ = ()
 order_level%(level)s_list.right_hand_side_list = [
-    [order_level%(level)s_list_item, order_level%(level)s_list_follow],
+    [ll1.OneOrMore(order_level%(level)s_list_item)],
     ]
 
-class level%(level)s_list(ListBase): pass
+class level%(level)s_list(ListBase):
+  __slots__ = ()
 level%(level)s_list.right_hand_side_list = [
     [unorder_level%(level)s_list],
     [order_level%(level)s_list],
@@ -336,6 +428,8 @@ exec('\n'.join(list_class_source_list))
 
 
 class text_block(PredictRule):
+  __slots__ = ()
+
   right_hand_side_list = [
       [paragraph],
       [title],
@@ -344,54 +438,160 @@ class text_block(PredictRule):
       [level1_list],
       ]
 
-class document(PredictRule): pass
+class document(PredictRule):
+  __slots__ = ()
 document.right_hand_side_list = [
-    [text_block, document],
-    [],
+    [ll1.ZeroOrMore(text_block)],
     ]
 
 
 class TwikiParser(object):
-  def __init__(self):
+  """The twiki parser.
+
+  The grammar is compiled once in the constructor and never changed after, and
+  all the state of parsing a document is local to the call, so one
+  TwikiParser could be shared by threads parsing documents concurrently.
+  """
+
+  def __init__(self, grammar_cache_path=None, generated_module=None):
+    """Initialize the parser.
+
+    Args:
+      grammar_cache_path: an optional file caching the compiled grammar,
+          see ll1.Parser. By default the grammar is always compiled, and
+          nothing is written. For the twiki grammar, loading the cache is
+          slower than compiling the grammar, so the cache only pays off for
+          much larger grammars.
+      generated_module: an optional module generated by GenerateModule to
+          parse with, see ll1.Parser.UseGeneratedModule.
+
+    Raises:
+      ll1.Error: when generated_module is out of date with the grammar.
+    """
     predict_rule_list = [document]
     for item in globals().values():
       if hasattr(item, 'right_hand_side_list') and item != document:
         predict_rule_list.append(item)
 
-    self.parser = ll1.Parser(predict_rule_list)
-
-  def Parse(self, source):
-    self.analysis_stack = self.parser.Parse(lexer.tokenize(source))
-
-    # Evaluate 'html' attribute of every node from bottom up.  Terminal has
-    # already had their HTML attribute ready.
-    for item in reversed(self.analysis_stack):
-      if not isinstance(item, ll1.Terminal):
-        item.Generate()
-
-    self.generate_toc()
-
-    return self.analysis_stack[0].html
-
-  def generate_toc(self):
-    toc_signature = '<toc/>'
-
+    self.parser = ll1.Parser(predict_rule_list, grammar_cache_path)
+    if generated_module is not None:
+      self.parser.UseGeneratedModule(generated_module)
+
+  def GenerateModule(self):
+    """Return the source of a parser module generated for the grammar."""
+    return self.parser.GenerateModule()
+
+  def Parse(self, source, instrument=None):
+    """Parse a twiki source into html.
+
+    Args:
+      source: the twiki source.
+      instrument: an optional ll1.ParseInstrument, for example
+          ll1.ParseStatistics, see ll1.Parser.Parse.
+    """
+    return self.ParseTokens_(lexer.tokenize_iter(source), instrument)
+
+  def ParseFile(self, input_file, instrument=None):
+    """Parse a twiki source file, reading its lines on demand."""
+    return self.ParseTokens_(lexer.tokenize_file_iter(input_file), instrument)
+
+  def ParseIter(self, source):
+    """Parse a twiki source into html, generated one block at a time.
+
+    The html of every top level text block is generated as soon as the block
+    is parsed, and the block is freed right after, so memory is bounded by
+    the largest block instead of the whole document. The fragments joined
+    are the same as the html returned by Parse.
+
+    If the document has a TOC, the html from the first TOC on is held until
+    the end of the document, since the TOC lists the titles after it, and
+    generated as the last fragment.
+
+    Yields:
+      The html fragments in order.
+
+    Raises:
+      ll1.Error: when parsing fails, after the fragments before the failure
+          have been generated.
+    """
+    return self.ParseTokensIter_(lexer.tokenize_iter(source))
+
+  def ParseFileIter(self, input_file):
+    """Same as ParseIter, reading the twiki source file on demand."""
+    return self.ParseTokensIter_(lexer.tokenize_file_iter(input_file))
+
+  def Validate(self, source):
+    """Check whether the twiki source could be parsed, without rendering it.
+
+    Returns:
+      None if the source could be parsed, otherwise the first token failing to
+      parse, whose line_no is the line of the failure, see
+      ll1.Parser.Recognize.
+
+    Raises:
+      lexer.Error: when the source could not be tokenized.
+    """
+    return self.parser.Recognize(lexer.tokenize_iter(source, lazy_html=True))
+
+  def ParseTokens_(self, token_iter, instrument=None):
+    analysis_stack = self.parser.Parse(token_iter, instrument)
+
+    writer = HtmlWriter()
+    writer.Write(analysis_stack[0])
+    self.generate_toc(writer)
+    return writer.GetValue()
+
+  def ParseTokensIter_(self, token_iter):
+    # One writer for the whole document, so the titles are numbered across
+    # the blocks.
+    writer = HtmlWriter()
+    fragment_list = []
+    def OnComplete(item):
+      if type(item) is not text_block:
+        return
+
+      # Once a TOC is written, the html is held in the writer until the TOC
+      # is generated.
+      writer.Write(item)
+      if not writer.toc_index_list:
+        fragment_list.append(writer.GetValue())
+        writer.fragment_list.clear()
+
+      # Drop the block from the document, so nothing done is referenced.
+      item.parent.children.clear()
+
+    session = ll1.ParseSession(self.parser, OnComplete)
+    for token in itertools.chain(token_iter, [None]):
+      if token is None:
+        session.finish()
+      else:
+        session.feed(token)
+
+      for fragment in fragment_list:
+        yield fragment
+      fragment_list.clear()
+
+    if writer.toc_index_list:
+      self.generate_toc(writer)
+      yield writer.GetValue()
+
+  def generate_toc(self, writer):
     # 0, If we don't have TOC at all, quit.
-    if self.analysis_stack[0].html.find(toc_signature) == -1:
+    if not writer.toc_index_list:
       return
 
-    # 1, Collect all the title rule into a list of 3 elements tuple of
-    # (level, text, anchor_id).
-    title_list = []
-    for rule in self.analysis_stack:
-      if isinstance(rule, TitleBase):
-        # TODO(xiaopanzhang): If the title text is a link, try to extract text.
-        title_list.append((
-            rule.level,
-            rule.title_html,
-            rule.anchor_id))
-
-    # 2, Generate the TOC as a HTML list.
+    # 1, Generate the TOC of the titles collected by the HtmlWriter as a HTML
+    # list.
+    # TODO(xiaopanzhang): If the title text is a link, try to extract text.
+    toc_html = self.GenerateTocHtml_(writer.title_list)
+
+    # 2. Fill the fragments reserved for the TOC, so the html is only joined
+    #    once.
+    for index in writer.toc_index_list:
+      writer.fragment_list[index] = toc_html
+
+  def GenerateTocHtml_(self, title_list):
+    # Generate the TOC of a list of (level, text, anchor_id) as a HTML list.
     text_list = []
     current_level = 0
     for level, text, anchor_id in title_list:
@@ -414,20 +614,28 @@ class TwikiParser(object):
     for i in range(current_level):
       text_list.append('</ul>')
 
-    # 3. Replace the TOC signature of the generated HTML in root node.
-    #    Unfortunately, my algorithm can't handle the sequence of generating
-    #    TOC and html.
-    self.analysis_stack[0].html = self.analysis_stack[0].html.replace(
-        toc_signature, '\n'.join(text_list))
+    return '\n'.join(text_list)
 
 
 def main():
+  if len(sys.argv) == 3 and sys.argv[1] == '--generate':
+    # Generate the source first, so a failure leaves no empty module behind.
+    source = TwikiParser().GenerateModule()
+    with open(sys.argv[2], 'w') as output_file:
+      output_file.write(source)
+    return
+
   if len(sys.argv) == 1:
-    input = sys.stdin.read()
+    input_file = sys.stdin
   else:
-    input = open(sys.argv[1]).read()
-
-  print(TwikiParser().Parse(input))
+    input_file = open(sys.argv[1])
+
+  try:
+    for fragment in TwikiParser().ParseFileIter(input_file):
+      sys.stdout.write(fragment)
+    sys.stdout.write('\n')
+  finally:
+    input_file.close()
 
 
 if __name__ == '__main__':
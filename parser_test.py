@@ -0,0 +1,212 @@
+#!/usr/bin/python3
+#
+# Test routines for parser. To run this test, in this directory, run
+# python3 parser_test.py
+
+import io
+import textwrap
+import types
+
+import lexer
+import ll1
+import parser
+
+SOURCE = textwrap.dedent("""\
+    %TOC%
+    ---+ Title *one*
+    Some *bold* and _italics_ words, =fixed= and [[WikiWord]].
+      Leading whitespace, %RED% red %ENDCOLOR% and [[http://a.com][a link]].
+
+    ---++ Lists
+       * first
+          1 nested
+          # again
+       * second
+          continued
+
+       1 ordered
+    <verbatim>
+    <b>as is</b>
+    </verbatim>
+    """)
+
+
+def TreeShape(analysis_stack):
+  # Describe every item of the analysis stack by its type, and for a predict
+  # rule, the indexes of its parent and children in the stack and its
+  # children_index.
+  index_table = dict((id(item), index)
+                     for index, item in enumerate(analysis_stack))
+  shape = []
+  for item in analysis_stack:
+    if isinstance(item, ll1.Terminal):
+      shape.append((type(item), item.value))
+    else:
+      shape.append((type(item),
+                    index_table[id(item.parent)]
+                    if hasattr(item, 'parent') else None,
+                    getattr(item, 'children_index', None),
+                    [index_table[id(child)] for child in item.children]))
+  return shape
+
+
+twiki_parser = parser.TwikiParser()
+
+# Every predict rule but the start one is the child of its parent at
+# children_index.
+analysis_stack = twiki_parser.parser.Parse(lexer.tokenize(SOURCE))
+for item in analysis_stack[1:]:
+  if not(isinstance(item, ll1.Terminal) or
+         item.parent.children[item.children_index] is item):
+    raise Exception(item)
+
+# The html of SOURCE, where the paragraphs, word lists and lists are
+# repetitions parsed from expressions.
+EXPECTED_HTML = (
+    '<ul>\n'
+    '<li><a href="#0">\n'
+    'Title <b>one</b>  \n'
+    '\n'
+    '</a></li>\n'
+    '<ul>\n'
+    '<li><a href="#1">\n'
+    'Lists  \n'
+    '\n'
+    '</a></li>\n'
+    '</ul>\n'
+    '</ul>\n'
+    '<h1><a name=0>Title <b>one</b>  \n'
+    '</a></h1>\n'
+    '<p>\n'
+    "Some <b>bold</b> and <i>italics</i> words , <code>fixed</code> and "
+    "<a href='/pwdoc/ViewPage/WikiWord'>WikiWord</a> .  \n"
+    '\n'
+    " Leading whitespace , <font color='RED'> red </font> and "
+    "<a href='http://a.com'>a  link</a> .  \n"
+    '\n'
+    '</p>\n'
+    '<p>\n'
+    '</p>\n'
+    '<h2><a name=1>Lists  \n'
+    '</a></h2>\n'
+    '\n'
+    '<ul>\n'
+    '<li>first  \n'
+    '\n'
+    '<ol>\n'
+    '<li>nested  \n'
+    '</li>\n'
+    '<li>again  \n'
+    '</li>\n'
+    '\n'
+    '</ol>\n'
+    '</li>\n'
+    '<li>second  \n'
+    'continued  \n'
+    '<p/></li>\n'
+    '\n'
+    '</ul>\n'
+    '\n'
+    '<ol>\n'
+    '<li>ordered  \n'
+    '</li>\n'
+    '\n'
+    '</ol>\n'
+    '<pre>\n'
+    '<b>as is</b>\n'
+    '</pre>\n'
+    '<p>\n'
+    '\n'
+    '</p>\n'
+    '<p>\n'
+    '\n'
+    '</p>\n'
+    )
+if not(twiki_parser.Parse(SOURCE) == EXPECTED_HTML):
+  raise Exception(twiki_parser.Parse(SOURCE))
+
+# The module generated for the grammar builds the same tree as Parse.
+generated_module = types.ModuleType('twiki_parser_generated')
+exec(twiki_parser.GenerateModule(), generated_module.__dict__)
+generated_parser = parser.TwikiParser(generated_module=generated_module)
+for source in [SOURCE, '', '\n', 'a\n', '<verbatim>\nx\n</verbatim>']:
+  expected_shape = TreeShape(twiki_parser.parser.Parse(lexer.tokenize(source)))
+  shape = TreeShape(generated_parser.parser.Parse(lexer.tokenize(source)))
+  if not(shape == expected_shape):
+    raise Exception((source, shape, expected_shape))
+  if not(generated_parser.Parse(source) == twiki_parser.Parse(source)):
+    raise Exception(source)
+
+for source in ['%TOC% x\n', '*a\n', '   * a\n         * b\n']:
+  for any_parser in [twiki_parser, generated_parser]:
+    try:
+      any_parser.Parse(source)
+      raise Exception(source)
+    except ll1.Error:
+      pass
+
+# The generated module is bound to the grammar it was generated from.
+generated_module.GRAMMAR_HASH = 'outdated'
+try:
+  parser.TwikiParser(generated_module=generated_module)
+  raise Exception(generated_module)
+except ll1.Error:
+  pass
+
+# Validate finds the first token failing to parse, without rendering.
+if not(twiki_parser.Validate(SOURCE) is None and
+       twiki_parser.Validate('') is None):
+  raise Exception('Validate')
+
+failure = twiki_parser.Validate('a\n\n%TOC% x\nb\n')
+if not(type(failure) == lexer.WORD and
+       failure.value == 'x' and
+       failure.line_no == 3):
+  raise Exception(failure)
+
+failure = twiki_parser.Validate('a\n*b c\n')
+if not(type(failure) == lexer.NEW_LINE and failure.line_no == 2):
+  raise Exception(failure)
+
+# ParseIter generates the html of Parse one text block at a time. With a
+# TOC, the html from the TOC on is generated at the end.
+source_without_toc = SOURCE.replace('%TOC%\n', '')
+source_with_late_toc = source_without_toc.replace('---++ Lists',
+                                                  '%TOC%\n---++ Lists')
+for source in [SOURCE, source_without_toc, source_with_late_toc, '', 'a']:
+  html = twiki_parser.Parse(source)
+  fragment_list = list(twiki_parser.ParseIter(source))
+  if not(''.join(fragment_list) == html and
+         ''.join(twiki_parser.ParseFileIter(io.StringIO(source))) == html):
+    raise Exception(source)
+
+fragment_list = list(twiki_parser.ParseIter(source_without_toc))
+if not(len(fragment_list) == 7 and
+       fragment_list[0].startswith('<h1>') and
+       fragment_list[5].startswith('<pre>')):
+  raise Exception(fragment_list)
+
+fragment_list = list(twiki_parser.ParseIter(source_with_late_toc))
+if not(len(fragment_list) == 3 and
+       fragment_list[-1].startswith('<ul>\n<li><a href="#0">')):
+  raise Exception(fragment_list)
+
+# The blocks before a failure are generated before ll1.Error is raised.
+fragment_list = []
+try:
+  for fragment in twiki_parser.ParseIter('---+ a\nb\n\n%TOC% x\n'):
+    fragment_list.append(fragment)
+  raise Exception(fragment_list)
+except ll1.Error:
+  pass
+if not(len(fragment_list) == 2 and fragment_list[0].startswith('<h1>')):
+  raise Exception(fragment_list)
+
+# A list whose child is neither ordered nor unordered is an ll1.Error.
+list_item = parser.ListBase()
+list_item.children.append(parser.ListItem())
+try:
+  list_item.HtmlParts(parser.HtmlWriter())
+  raise Exception(list_item)
+except ll1.Error:
+  pass